@@ -0,0 +1,248 @@
+"""
+Deterministic extraction of the §3(2) coal numbers (thermal coal tonnage, coal-fired capacity, coal share of
+revenue/operations) with compiled regexes over all chunks at once, aggregated with pandas/NumPy.
+
+The result is a set of pre-computed signals in the same format as the MAP output, so REDUCE gets the numbers
+(and how they compare to the thresholds) without the LLM having to dig them out, plus a mask of chunks that are
+only coal number tables and can skip MAP. A regex cannot tell thermal from metallurgical coal or one year from
+several, so the signals are low-confidence leads with the quote attached; whether a threshold is met is left to
+REDUCE.
+"""
+
+import re
+import numpy as np
+import pandas as pd
+
+# §3(2) thresholds, see MAP_USER_PREFIX in prompts.py
+COAL_TONNES_THRESHOLD_MT = 20.0  # > 20 million tonnes thermal coal extracted per year
+COAL_CAPACITY_THRESHOLD_MW = 10_000.0  # > 10,000 MW coal-fired generation capacity
+COAL_SHARE_THRESHOLD_PCT = 30.0  # >= 30 % of income or operations
+
+TABLE_DIGIT_RATIO = 0.2  # Share of digits among non-space characters above which a paragraph counts as a table
+TABLE_CHUNK_SHARE = 0.8  # Share of a chunk's characters in table paragraphs needed for it to skip MAP
+_NEAR_WORDS = 8  # Max words between a figure and the word that makes it a coal figure (same clause only)
+_MAX_SENTENCE_CHARS = 400  # Longer "sentences" (usually tables) are split further on line breaks
+
+_NUM = r"(?<!\d)(?<!\d[.,])(?P<num>\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)"
+_CLAUSE_BREAK_RX = re.compile(r"[,;:]|\b(?:while|whereas|but|although|though|compared|versus|vs)\b", re.IGNORECASE)
+
+_COAL_RX = re.compile(r"\bcoal", re.IGNORECASE)
+_TONNES_RX = re.compile(
+    _NUM + r"\s*(?P<unit>million\s+(?:metric\s+)?(?:tonnes|tons)|billion\s+(?:metric\s+)?(?:tonnes|tons)|"
+    r"thousand\s+(?:metric\s+)?(?:tonnes|tons)|mn\s*t(?:onnes)?\b|mtpa\b|mt\b|kt\b|(?:metric\s+)?(?:tonnes|tons)\b)",
+    re.IGNORECASE
+)
+# Tonnes only count next to a production word; reserves, resources and emissions are stated in tonnes too
+_PRODUCTION_RX = re.compile(r"\b(?:produc(?:ed|es|e|ing|tion)|mined|mining|extract(?:ed|s|ing|ion)|output)\b", re.IGNORECASE)
+_TONNES_EXCLUDE_RX = re.compile(r"reserve|resource|co2|co₂|carbon dioxide|emission|ghg|greenhouse", re.IGNORECASE)
+_CAPACITY_RX = re.compile(_NUM + r"\s*(?P<unit>gw[e]?\b|gigawatts?|mw[e]?\b|megawatts?)", re.IGNORECASE)
+_CAPACITY_CONTEXT_RX = re.compile(r"coal[- ]fired|coal[- ]based|coal power|coal plant|coal unit|thermal|capacity|generat", re.IGNORECASE)
+_SHARE_RX = re.compile(r"(?<![\d.])(?P<num>\d+(?:\.\d+)?)\s*(?:%|per\s*cent\b|percent\b)", re.IGNORECASE)
+_SHARE_CONTEXT_RX = re.compile(r"revenue|income|sales|turnover|ebitda|operations|generation|output|energy mix|power mix", re.IGNORECASE)
+_MONEY_RX = re.compile(
+    r"(?P<cur>[$€£¥]|usd|eur|gbp|nok|aud|idr|inr|zar|cny|rmb)\s?" + _NUM + r"\s*(?P<unit>billion|bn|million|mn|m\b|thousand)?",
+    re.IGNORECASE
+)
+_COAL_REVENUE_CONTEXT_RX = re.compile(r"revenue|sales|turnover", re.IGNORECASE)
+# Coal and a revenue word both in the clause around the amount (checked on that clause only, see _is_near)
+_COAL_REVENUE_RX = re.compile(r"\bcoal.*\b(?:revenue|sales|turnover)|\b(?:revenue|sales|turnover).*\bcoal", re.IGNORECASE)
+_TOTAL_REVENUE_RX = re.compile(r"total\s+(?:revenue|sales|turnover)|(?:group|consolidated)\s+(?:revenue|sales|turnover)", re.IGNORECASE)
+_CONDUCT_RX = re.compile(
+    r"weapon|munition|tobacco|cannabis|human rights|forced labou?r|child labou?r|fatalit|spill|penalt|\bfine[sd]?\b|"
+    r"sanction|embargo|brib|corrupt|fraud|money laundering|investigation|lawsuit|litigation|emission|greenhouse|deforest|violation",
+    re.IGNORECASE
+)
+
+# Unit -> multiplier into million tonnes / MW / millions of currency
+_TONNES_UNITS = [(r"^bil", 1_000.0), (r"^thou|^kt", 0.001), (r"^mil|^mn|^mt", 1.0), (r".", 1e-6)]
+_CAPACITY_UNITS = [(r"^g", 1_000.0), (r".", 1.0)]
+_MONEY_UNITS = [(r"^b", 1_000.0), (r"^t", 0.001), (r"^m", 1.0), (r"^$", 1e-6)]
+
+
+def _scale(units: pd.Series, table) -> np.ndarray:
+    u = units.fillna("").str.lower().str.strip()
+    return np.select([u.str.contains(rx) for rx, _ in table], [m for _, m in table], default=1.0)
+
+
+def _to_number(nums: pd.Series) -> pd.Series:
+    return pd.to_numeric(nums.str.replace(",", "", regex=False), errors="coerce")
+
+
+def _sentences(chunks: pd.DataFrame) -> pd.DataFrame:
+    """One row per sentence, with the doc and chunk it came from (split once, shared by all metrics)."""
+    sent = chunks.assign(sentence=chunks["text"].str.split(r"(?<=[.!?;])\s+|\n{2,}", regex=True)).explode("sentence")
+    sent = sent[sent["sentence"].str.len() > 0].reset_index(drop=True)
+    long = sent["sentence"].str.len() > _MAX_SENTENCE_CHARS
+    if long.any():
+        sent = pd.concat([sent[~long], sent[long].assign(sentence=sent.loc[long, "sentence"].str.split("\n")).explode("sentence")])
+    return sent.assign(sentence=sent["sentence"].str.replace(r"\s+", " ", regex=True).str.strip()).reset_index(drop=True)
+
+
+def _is_near(sentence, start, end, term_rx):
+    """True if term_rx is found within _NEAR_WORDS words of sentence[start:end], in the same clause."""
+    before = _CLAUSE_BREAK_RX.split(sentence[:start])[-1].split()[-_NEAR_WORDS:]
+    after = _CLAUSE_BREAK_RX.split(sentence[end:])[0].split()[:_NEAR_WORDS]
+    return bool(term_rx.search(" ".join(before + ["|"] + after)))
+
+
+def _matches(sent: pd.DataFrame, rx, near=None, not_near=None) -> pd.DataFrame:
+    """
+    All regex matches in the sentences, joined back to doc/chunk/sentence. With near (a regex), only matches
+    that have it close by in the same clause are kept, and with not_near only those that don't; that check runs
+    per match, so only pass few sentences.
+    """
+    if near is None:
+        found = sent["sentence"].str.extractall(rx) if not sent.empty else pd.DataFrame()
+    else:
+        rows = [(i, m.groupdict()) for i, text in sent["sentence"].items() for m in rx.finditer(text)
+                if _is_near(text, m.start(), m.end(), near)
+                and not (not_near and _is_near(text, m.start(), m.end(), not_near))]
+        found = pd.DataFrame([g for _, g in rows], index=[i for i, _ in rows])
+    if found.empty:
+        return pd.DataFrame(columns=["doc", "chunk", "sentence", "value", "unit", "cur"])
+    if near is None:
+        found = found.reset_index(level=1, drop=True)
+    found = found.join(sent[["doc", "chunk", "sentence"]])
+    found["value"] = _to_number(found["num"])
+    if "unit" not in found:
+        found["unit"] = ""
+    if "cur" not in found:
+        found["cur"] = ""
+    return found.dropna(subset=["value"])
+
+
+def extract_coal_metrics(texts, docs=None) -> pd.DataFrame:
+    """
+    Coal figures found in a list of chunk texts (docs gives the document of each chunk; one doc if omitted).
+    Returns one row per figure: doc, chunk (0-based), metric, value (Mt, MW, % or millions), sentence.
+    """
+    chunks = pd.DataFrame({
+        "doc": docs if docs is not None else [0] * len(texts),
+        "chunk": np.arange(len(texts)),
+        "text": pd.Series(texts, dtype="object").fillna(""),
+    })
+    all_sent = _sentences(chunks)
+    sent = all_sent[all_sent["sentence"].str.contains(_COAL_RX)]
+    columns = ["doc", "chunk", "metric", "value", "cur", "sentence"]
+    if sent.empty:
+        return pd.DataFrame(columns=columns)
+
+    frames = []
+    tonnes = _matches(sent[~sent["sentence"].str.contains(_TONNES_EXCLUDE_RX)], _TONNES_RX, near=_PRODUCTION_RX)
+    frames.append(tonnes.assign(metric="coal_mt", value=tonnes["value"] * _scale(tonnes["unit"], _TONNES_UNITS)))
+
+    cap = _matches(sent[sent["sentence"].str.contains(_CAPACITY_CONTEXT_RX)], _CAPACITY_RX, near=_COAL_RX)
+    frames.append(cap.assign(metric="coal_mw", value=cap["value"] * _scale(cap["unit"], _CAPACITY_UNITS)))
+
+    share = _matches(sent[sent["sentence"].str.contains(_SHARE_CONTEXT_RX)], _SHARE_RX, near=_COAL_RX)
+    frames.append(share[share["value"] <= 100].assign(metric="coal_share_pct"))
+
+    money = _matches(sent[sent["sentence"].str.contains(_COAL_REVENUE_CONTEXT_RX)], _MONEY_RX,
+                     near=_COAL_REVENUE_RX, not_near=_TOTAL_REVENUE_RX)
+    money = money.assign(value=money["value"] * _scale(money["unit"], _MONEY_UNITS), cur=money["cur"].str.upper())
+    frames.append(money.assign(metric="coal_revenue_m"))
+
+    # Total revenue is usually stated without "coal" in the sentence, so look for it in all sentences
+    total = _matches(all_sent[all_sent["sentence"].str.contains(_TOTAL_REVENUE_RX)], _MONEY_RX, near=_TOTAL_REVENUE_RX)
+    total = total.assign(value=total["value"] * _scale(total["unit"], _MONEY_UNITS), cur=total["cur"].str.upper())
+    frames.append(total.assign(metric="total_revenue_m"))
+
+    frames = [f[columns] for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    out = pd.concat(frames, ignore_index=True)
+    return out.drop_duplicates(["doc", "metric", "value", "sentence"]).reset_index(drop=True)
+
+
+def summarise_coal_metrics(metrics: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per doc with the largest figure per metric, the coal revenue ratio (when coal and total revenue
+    are in the same currency) and the threshold flags.
+    """
+    if metrics.empty:
+        return pd.DataFrame()
+    best = metrics.loc[metrics.groupby(["doc", "metric"])["value"].idxmax()]
+    wide = best.pivot(index="doc", columns="metric", values="value")
+    for col in ("coal_mt", "coal_mw", "coal_share_pct", "coal_revenue_m", "total_revenue_m"):
+        if col not in wide:
+            wide[col] = np.nan
+    cur = best.pivot(index="doc", columns="metric", values="cur").reindex(columns=["coal_revenue_m", "total_revenue_m"])
+    same_cur = (cur["coal_revenue_m"].fillna("") == cur["total_revenue_m"].fillna("")).to_numpy()
+    ratio = np.where(
+        same_cur & (wide["total_revenue_m"].to_numpy() >= wide["coal_revenue_m"].to_numpy()),
+        wide["coal_revenue_m"].to_numpy() / wide["total_revenue_m"].to_numpy() * 100, np.nan
+    )
+    wide["coal_revenue_ratio_pct"] = ratio
+    wide["over_tonnes"] = wide["coal_mt"] > COAL_TONNES_THRESHOLD_MT
+    wide["over_capacity"] = wide["coal_mw"] > COAL_CAPACITY_THRESHOLD_MW
+    wide["over_share"] = (wide["coal_share_pct"] >= COAL_SHARE_THRESHOLD_PCT) | (wide["coal_revenue_ratio_pct"] >= COAL_SHARE_THRESHOLD_PCT)
+    return wide
+
+
+def coal_signals(metrics: pd.DataFrame, doc=0):
+    """
+    Pre-computed §3(2) leads for one doc, in the MAP signal format (chunk is 1-based like MAP's): the largest
+    figure per metric with its quote, how it compares to the threshold and how many figures were found.
+    Always low confidence and never "serious"; REDUCE decides from the quotes whether a threshold is met.
+    """
+    doc_metrics = metrics[metrics["doc"] == doc]
+    if doc_metrics.empty:
+        return []
+    summary = summarise_coal_metrics(doc_metrics).iloc[0]
+    best = doc_metrics.loc[doc_metrics.groupby("metric")["value"].idxmax()].set_index("metric")
+    found = doc_metrics["metric"].value_counts()
+
+    checks = [
+        ("coal_mt", "coal production {:,.1f} million tonnes (threshold > 20 Mt/yr of thermal coal)", summary["over_tonnes"]),
+        ("coal_mw", "coal-fired capacity {:,.0f} MW (threshold > 10,000 MW)", summary["over_capacity"]),
+        ("coal_share_pct", "coal share {:.1f}% (threshold >= 30% of income/operations)", summary["coal_share_pct"] >= COAL_SHARE_THRESHOLD_PCT),
+    ]
+    signals = []
+    for metric, template, over in checks:
+        if metric not in best.index:
+            continue
+        row = best.loc[metric]
+        signals.append(_signal(row, template.format(row["value"]), bool(over), found[metric]))
+    if not np.isnan(summary["coal_revenue_ratio_pct"]):
+        row = best.loc["coal_revenue_m"]
+        text = (f"coal revenue {row['value']:,.0f}m of total revenue {summary['total_revenue_m']:,.0f}m "
+                f"= {summary['coal_revenue_ratio_pct']:.1f}% (threshold >= 30%)")
+        signals.append(_signal(row, text, summary["coal_revenue_ratio_pct"] >= COAL_SHARE_THRESHOLD_PCT, found["coal_revenue_m"]))
+    return signals
+
+
+def _signal(row, quantitative_data, over_threshold, figures_found):
+    note = "above the threshold if the quote is about it" if over_threshold else "below the threshold"
+    if figures_found > 1:
+        note += f"; largest of {figures_found} figures found"
+    return {
+        "criterion": "§3(2)-coal",
+        "evidence": row["sentence"],
+        "severity": "moderate" if over_threshold else "minor",
+        "confidence": "low",
+        "quantitative_data": f"[pre-computed by regex, check the quote] {quantitative_data} - {note}",
+        "forward_looking": "",
+        "chunk": int(row["chunk"]) + 1,
+        "source": "coal_metrics",
+    }
+
+
+def coal_table_mask(texts, metrics: pd.DataFrame, doc=0) -> np.ndarray:
+    """
+    True for chunks that only matter for the coal numbers: nearly all of the text is in table paragraphs
+    (mostly digits), the chunk has coal figures found by extract_coal_metrics and nothing that points at a
+    conduct criterion. These can skip MAP. A chunk with a table and some prose around it still goes to MAP.
+    """
+    s = pd.Series(texts, dtype="object").fillna("")
+    mask = np.zeros(len(s), dtype=bool)
+    chunk_ids = metrics.loc[(metrics["doc"] == doc) & metrics["metric"].isin(["coal_mt", "coal_mw", "coal_share_pct"]), "chunk"]
+    candidates = s.iloc[np.sort(chunk_ids.astype(int).unique())]  # Only chunks with coal figures are checked further
+    if candidates.empty:
+        return mask
+    para = candidates.str.split(r"\n\s*\n", regex=True).explode()
+    chars = para.str.count(r"\S")
+    is_table = para.str.count(r"\d") / chars.clip(lower=1) > TABLE_DIGIT_RATIO
+    table_share = (chars * is_table).groupby(level=0).sum() / chars.groupby(level=0).sum().clip(lower=1)
+    skip = (table_share >= TABLE_CHUNK_SHARE) & ~candidates.str.contains(_CONDUCT_RX)
+    mask[skip.index[skip.to_numpy()]] = True
+    return mask
@@ -0,0 +1,87 @@
+"""
+Evidence check for MAP signals: does the quoted evidence actually appear in the report?
+
+The pages of a document are normalised (case, punctuation, line-break hyphenation and whitespace are ignored)
+and indexed as overlapping word n-grams. A quote is looked up n-gram by n-gram, so checking it costs the
+length of the quote, not of the report, and thousands of signals per batch are checked in milliseconds.
+A quote counts as verified when enough of its n-grams are found (so "..." cuts and small OCR differences
+still pass, paraphrases do not), and it gets the page most of them are on.
+"""
+
+import re
+import bisect
+import unicodedata
+from collections import Counter
+
+SHINGLE_WORDS = 5  # Words per n-gram; shorter quotes are matched as a whole
+MIN_COVERAGE = 0.6  # Share of a quote's n-grams that must be found in the report
+
+_WORD_RX = re.compile(r"\w+")
+_HYPHEN_BREAK_RX = re.compile(r"(\w)-\s*\n\s*(\w)")
+
+
+def normalise_words(text):
+    """Lower-case words of a text, with "environ-\\nmental" joined and punctuation dropped."""
+    text = unicodedata.normalize("NFKC", text or "")
+    text = _HYPHEN_BREAK_RX.sub(r"\1\2", text)
+    return _WORD_RX.findall(text.casefold())
+
+
+class EvidenceIndex:
+    """Word n-gram index over the pages of one document (built once per file, queried once per signal)."""
+
+    def __init__(self, pages, n=SHINGLE_WORDS):
+        self.n = n
+        self._shingles = {}  # hash of n words -> first page index it appears on
+        words, page_starts = [], []
+        for i, page in enumerate(pages):
+            page_starts.append(len(words))
+            words.extend(normalise_words(page))
+            # n-grams across a page break are indexed too (a quote can run over two pages)
+            for j in range(max(page_starts[-1] - n + 1, 0), len(words) - n + 1):
+                self._shingles.setdefault(hash(tuple(words[j:j + n])), i)
+        self._words = words
+        self._page_starts = page_starts
+        self._text = None  # Joined words, only built if a short quote needs it
+
+    def locate(self, quote):
+        """(1-based page or None, share of the quote found). Quotes shorter than n words must match exactly."""
+        words = normalise_words(quote)
+        if not words:
+            return None, 0.0
+        if len(words) < self.n:
+            return self._locate_short(words)
+        pages = Counter()
+        shingles = [hash(tuple(words[j:j + self.n])) for j in range(len(words) - self.n + 1)]
+        for h in shingles:
+            page = self._shingles.get(h)
+            if page is not None:
+                pages[page] += 1
+        if not pages:
+            return None, 0.0
+        page, _ = pages.most_common(1)[0]
+        return page + 1, sum(pages.values()) / len(shingles)
+
+    def _locate_short(self, words):
+        if self._text is None:
+            self._text = " " + " ".join(self._words) + " "
+        pos = self._text.find(" " + " ".join(words) + " ")
+        if pos < 0:
+            return None, 0.0
+        word_index = self._text.count(" ", 0, pos + 1) - 1  # Words are single-space separated
+        return bisect.bisect_right(self._page_starts, word_index), 1.0
+
+
+def verify_signals(signals, index, min_coverage=MIN_COVERAGE):
+    """
+    Add "page" and "verified" to every signal (in place). Returns the number of unverified signals.
+    Signals without evidence text are left unverified.
+    """
+    unverified = 0
+    for s in signals:
+        page, coverage = index.locate(s.get("evidence") or "")
+        s["page"] = page
+        s["verified"] = coverage >= min_coverage
+        if not s["verified"]:
+            unverified += 1
+    return unverified
@@ -0,0 +1,204 @@
+"""
+Durable job queue on SQLite, shared by the HTTP service (service.py) and the workers (worker.py).
+
+One job is one submitted batch and one task is one PDF of that batch. Workers claim tasks with a lease,
+so if a worker dies its task goes back in the queue once the lease runs out. No external broker is needed.
+
+The queue is for one host: SQLite in WAL mode needs shared memory, which network filesystems (NFS, SMB)
+do not provide. Scale by starting more worker processes on that host.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+from contextlib import contextmanager
+
+from pipeline import error_result
+
+DEFAULT_DB_PATH = os.environ.get("ESG_QUEUE_DB", "esg_queue.db")
+DEFAULT_UPLOAD_DIR = os.environ.get("ESG_UPLOAD_DIR", "uploads")
+TASK_LEASE_SEC = 10 * 60  # A worker must finish (or renew the lease) within this time, or the task is handed out again
+MAX_TASK_ATTEMPTS = 3  # After this many failed attempts the task is marked failed and keeps its error row
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id      TEXT PRIMARY KEY,
+    created_at  REAL NOT NULL,
+    total       INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id      TEXT NOT NULL REFERENCES jobs(job_id),
+    file_name   TEXT NOT NULL,
+    pdf_path    TEXT NOT NULL,
+    status      TEXT NOT NULL DEFAULT 'queued',  -- queued | running | done | failed
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    worker_id   TEXT,
+    lease_until REAL,
+    result      TEXT,  -- JSON result row, set when done (or failed for good)
+    error       TEXT,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status, lease_until);
+CREATE INDEX IF NOT EXISTS idx_tasks_job ON tasks(job_id);
+"""
+
+
+class JobQueue:
+    """Small wrapper around the SQLite file. Every call opens its own connection, so it is safe across threads and processes."""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        with self._db() as con:
+            con.execute("PRAGMA journal_mode=WAL")  # Readers (status polling) don't block the workers
+            con.executescript(_SCHEMA)
+
+    @contextmanager
+    def _db(self):
+        con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        try:
+            yield con
+        finally:
+            con.close()
+
+    def create_job(self, files):
+        """Queue one task per (file_name, pdf_path) and return the new job_id."""
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._db() as con:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute("INSERT INTO jobs (job_id, created_at, total) VALUES (?, ?, ?)", (job_id, now, len(files)))
+            con.executemany(
+                "INSERT INTO tasks (job_id, file_name, pdf_path, updated_at) VALUES (?, ?, ?, ?)",
+                [(job_id, name, path, now) for name, path in files]
+            )
+            con.execute("COMMIT")
+        return job_id
+
+    def claim_task(self, worker_id, lease_sec=TASK_LEASE_SEC, max_attempts=MAX_TASK_ATTEMPTS, on_give_up=None):
+        """
+        Take the oldest queued task (or one whose lease ran out). Returns a dict, or None if there is nothing to do.
+        A task whose lease ran out on its last attempt (its worker died, e.g. on a PDF that crashes MuPDF) is not
+        handed out again but marked failed with an error row; on_give_up(job_id, row) gets each of those rows.
+        """
+        now = time.time()
+        with self._db() as con:
+            con.execute("BEGIN IMMEDIATE")  # Write lock, so two workers can never claim the same task
+            given_up = con.execute(
+                "SELECT task_id, job_id, file_name, attempts FROM tasks "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, max_attempts)
+            ).fetchall()
+            rows = []
+            for t in given_up:
+                error = f"Processing error: the worker stopped before finishing, on all {t['attempts']} attempts"
+                rows.append((t["job_id"], error_result(t["file_name"], error)))
+                con.execute(
+                    "UPDATE tasks SET status = 'failed', error = ?, result = ?, lease_until = NULL, updated_at = ? "
+                    "WHERE task_id = ?",
+                    (error, json.dumps(rows[-1][1], ensure_ascii=False), now, t["task_id"])
+                )
+            row = con.execute(
+                "SELECT task_id, job_id, file_name, pdf_path, attempts FROM tasks "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY task_id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is not None:
+                con.execute(
+                    "UPDATE tasks SET status = 'running', worker_id = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE task_id = ?",
+                    (worker_id, now + lease_sec, now, row["task_id"])
+                )
+            con.execute("COMMIT")
+        if on_give_up:
+            for job_id, result in rows:
+                on_give_up(job_id, result)
+        if row is None:
+            return None
+        task = dict(row)
+        task["attempts"] += 1
+        return task
+
+    def renew_lease(self, task_id, worker_id, lease_sec=TASK_LEASE_SEC):
+        """Keep a long-running task from being handed to another worker."""
+        with self._db() as con:
+            con.execute(
+                "UPDATE tasks SET lease_until = ?, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                (time.time() + lease_sec, time.time(), task_id, worker_id)
+            )
+
+    def complete_task(self, task_id, worker_id, result):
+        """
+        Store the result row. Returns False (and changes nothing) if the worker no longer holds the task,
+        i.e. its lease ran out and the task was handed to another worker.
+        """
+        with self._db() as con:
+            cur = con.execute(
+                "UPDATE tasks SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                (json.dumps(result, ensure_ascii=False), time.time(), task_id, worker_id)
+            )
+            return cur.rowcount > 0
+
+    def fail_task(self, task_id, worker_id, error, final_result=None, max_attempts=MAX_TASK_ATTEMPTS):
+        """
+        Put the task back in the queue, or mark it failed (keeping final_result as its row) once attempts run out.
+        Returns the new status ("queued" or "failed"), or None if the worker no longer holds the task.
+        """
+        with self._db() as con:
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute(
+                "SELECT attempts FROM tasks WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                (task_id, worker_id)
+            ).fetchone()
+            if row is None:
+                status = None
+            elif row["attempts"] < max_attempts:
+                status = "queued"
+                con.execute(
+                    "UPDATE tasks SET status = 'queued', error = ?, worker_id = NULL, lease_until = NULL, "
+                    "updated_at = ? WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                    (error, time.time(), task_id, worker_id)
+                )
+            else:
+                status = "failed"
+                con.execute(
+                    "UPDATE tasks SET status = 'failed', error = ?, result = ?, lease_until = NULL, "
+                    "updated_at = ? WHERE task_id = ? AND worker_id = ? AND status = 'running'",
+                    (error, json.dumps(final_result, ensure_ascii=False) if final_result else None,
+                     time.time(), task_id, worker_id)
+                )
+            con.execute("COMMIT")
+        return status
+
+    def job_status(self, job_id):
+        """Task counts per status for one job, or None if the job does not exist."""
+        with self._db() as con:
+            job = con.execute("SELECT job_id, created_at, total FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = {s: 0 for s in ("queued", "running", "done", "failed")}
+            for row in con.execute("SELECT status, COUNT(*) AS n FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)):
+                counts[row["status"]] = row["n"]
+        finished = counts["done"] + counts["failed"]
+        return {
+            "job_id": job["job_id"],
+            "created_at": job["created_at"],
+            "total": job["total"],
+            "finished": finished,
+            "status": "done" if finished == job["total"] else ("running" if counts["running"] or finished else "queued"),
+            "tasks": counts,
+        }
+
+    def job_results(self, job_id):
+        """Result rows of the finished tasks of one job, in upload order."""
+        with self._db() as con:
+            rows = con.execute(
+                "SELECT result FROM tasks WHERE job_id = ? AND result IS NOT NULL ORDER BY task_id", (job_id,)
+            ).fetchall()
+        return [json.loads(r["result"]) for r in rows]
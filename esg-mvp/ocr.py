@@ -0,0 +1,118 @@
+"""
+OCR fallback for scanned pages, so mixed scanned/native reports need no manual pre-pass.
+
+Only pages with (almost) no selectable text and an image on them are OCR'd. They are rendered with fitz and
+read by Tesseract (pytesseract, optional: pip install pytesseract, plus the tesseract program) in the shared
+process pool. The text is cached on disk by a hash of the page's content and images, so a rerun (or the same
+report uploaded again, or a dry run before the real one) does not OCR anything twice.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+import fitz
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:  # OCR is optional; without it scanned pages only get a warning
+    pytesseract = None
+
+OCR_PAGE_MIN_CHARS = 100  # Pages with less selectable text than this (and an image) are OCR'd
+OCR_DPI = 300
+OCR_LANG = os.environ.get("ESG_OCR_LANG", "eng")  # Tesseract language(s), e.g. "eng+nor"
+OCR_CACHE_DIR = os.environ.get("ESG_OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "esg_ocr_cache"))
+
+
+def ocr_available():
+    return pytesseract is not None and shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+
+
+def _page_hash(doc, page):
+    """Hash of what the page shows (content stream and embedded images), without rendering it."""
+    h = hashlib.sha256(f"{OCR_DPI}|{OCR_LANG}".encode("utf-8"))
+    h.update(page.read_contents())
+    for img in page.get_images(full=True):
+        h.update(doc.xref_stream_raw(img[0]) or b"")
+    return h.hexdigest()
+
+
+def _cache_path(page_hash):
+    return os.path.join(OCR_CACHE_DIR, page_hash[:2], f"{page_hash}.txt")
+
+
+def _read_cache(page_hash):
+    try:
+        with open(_cache_path(page_hash), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write_cache(page_hash, text):
+    path = _cache_path(page_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _ocr_page(args):
+    """Runs in a worker process: render one page and OCR it. Returns (text, seconds)."""
+    pdf_path, index = args
+    started = time.monotonic()
+    doc = fitz.open(pdf_path, filetype="pdf")
+    try:
+        pix = doc[index].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+        image = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    finally:
+        doc.close()
+    text = pytesseract.image_to_string(image, lang=OCR_LANG)
+    return text, time.monotonic() - started
+
+
+def ocr_low_text_pages(pdf_path, pages, get_pool=None):
+    """
+    Replace the text of scanned pages with OCR text. Returns (pages, report) where report has
+    "pages" (1-based numbers of the low-text pages), "seconds" ({page: OCR time}, 0 for cache hits),
+    "cached" (number of cache hits) and "unavailable" (low-text pages left as they were, no OCR engine).
+    get_pool returns the process pool to OCR in; it is only called when there is something to OCR.
+    """
+    report = {"pages": [], "seconds": {}, "cached": 0, "unavailable": 0}
+    doc = fitz.open(pdf_path, filetype="pdf")
+    try:
+        todo = []  # (index, page hash)
+        for i, page in enumerate(doc):
+            if len(pages[i].strip()) >= OCR_PAGE_MIN_CHARS or not page.get_images():
+                continue
+            report["pages"].append(i + 1)
+            page_hash = _page_hash(doc, page)
+            text = _read_cache(page_hash)
+            if text is None:
+                todo.append((i, page_hash))
+                continue
+            pages[i] = text
+            report["seconds"][i + 1] = 0.0
+            report["cached"] += 1
+    finally:
+        doc.close()
+
+    if todo and not ocr_available():
+        report["unavailable"] = len(todo)
+        return pages, report
+
+    # Inside a pool worker (e.g. the dry-run planner) the pages are OCR'd one by one instead of in a nested pool
+    jobs = [(pdf_path, i) for i, _ in todo]
+    if not jobs or get_pool is None or multiprocessing.parent_process() is not None:
+        results = map(_ocr_page, jobs)
+    else:
+        results = get_pool().map(_ocr_page, jobs)
+    for (i, page_hash), (text, seconds) in zip(todo, results):
+        _write_cache(page_hash, text)
+        pages[i] = text
+        report["seconds"][i + 1] = seconds
+    return pages, report
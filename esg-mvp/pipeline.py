@@ -0,0 +1,1094 @@
+"""
+MAP-REDUCE classification pipeline, kept free of Streamlit so it can be imported by the page (app5.py),
+the job-queue service (service.py) and the workers (worker.py).
+"""
+
+# Import our packages
+import os
+import re
+import json
+import time
+import asyncio
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import aiohttp
+import fitz
+
+# Import prompts from separate file
+from prompts import (
+    MAP_SYSTEM,
+    MAP_USER_PREFIX,
+    REDUCE_SYSTEM,
+    REDUCE_USER_PREFIX,
+    REDUCE_USER_INSTRUCTIONS
+)
+from sections import MAP_ORDER, split_sections
+from coal_metrics import extract_coal_metrics, coal_signals, coal_table_mask
+from evidence_index import EvidenceIndex, verify_signals
+from ocr import ocr_low_text_pages
+
+# Import the Pydantic library (used to clean and validate data). We use v2 validator, and fall back to v1 if needed.
+from pydantic import BaseModel, Field, ValidationError
+try:
+    from pydantic import field_validator as _field_validator
+except Exception:
+    from pydantic import validator as _field_validator      
+
+#  Credentials from NHH (workers and the service can set them through the environment instead)
+API_KEY = os.environ.get("ESG_API_KEY", "x")
+API_URL = os.environ.get("ESG_API_URL", "x")
+MODEL_NAME = os.environ.get("ESG_MODEL_NAME", "gpt-5-mini")
+
+# Model cascade, empty = MODEL_NAME / API_URL. MAP runs on the (cheaper) triage model first, and only chunks whose
+# signals need a closer look (ESCALATE_* below) are re-run on MODEL_NAME. REDUCE can have a model of its own.
+# On Azure the model is part of the deployment URL, so set the URL as well.
+MAP_TRIAGE_MODEL = os.environ.get("ESG_MAP_TRIAGE_MODEL", "")
+MAP_TRIAGE_URL = os.environ.get("ESG_MAP_TRIAGE_URL", "")
+REDUCE_MODEL = os.environ.get("ESG_REDUCE_MODEL", "")
+REDUCE_URL = os.environ.get("ESG_REDUCE_URL", "")
+
+# Package to help count tokens, check so it's installed, see "requirements.txt". 
+import tiktoken
+TOK = tiktoken.get_encoding("cl100k_base")
+
+# Config parameters for the model
+MAX_CONTEXT_TOKENS = 128_000
+CHUNK_TARGET_TOKENS = 5_000  # See our report 
+CHUNK_OVERLAP_TOKENS = 300  # Only used when a single paragraph is larger than the target size.
+REQUEST_TIMEOUT_SEC = 120
+STREAM_RESPONSES = os.environ.get("ESG_STREAM", "") == "1"  # Stream MAP answers (SSE) and pick up signals as they complete
+MAX_CONCURRENT_REQUESTS = 10  # Parallel execution limit, to avoid overwhelming the API
+LOW_TEXT_THRESHOLD = 2_000  # warn if PDF has little selectable text so its not a scanned document
+OCR_FALLBACK = True  # OCR pages without selectable text (ocr.py), needs pytesseract + tesseract installed
+COAL_PRESIGNALS = True  # Add regex-extracted §3(2) coal numbers (coal_metrics.py) to the signals sent to REDUCE
+SKIP_MAP_FOR_COAL_TABLES = True  # Chunks that are only coal number tables are covered by those and skip MAP
+SKIP_LOW_YIELD_SECTIONS = True  # Leave out sections with the "skip" rule in sections.py (auditor's report etc.)
+VERIFY_EVIDENCE = True  # Look up every signal's evidence quote in the report (evidence_index.py): adds "page" and "verified"
+DROP_UNVERIFIED_SIGNALS = False  # Leave signals whose quote isn't in the report out of REDUCE (they are still stored)
+MAX_INFLIGHT_BYTES = 256 * 1024 ** 2  # Total size of the PDFs being processed at the same time (caps memory, not the batch size)
+SPOOL_DIR = os.environ.get("ESG_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "esg_spool"))
+SPOOL_BLOCK_BYTES = 1024 * 1024
+DEDUP_STRATEGY = "prefix"  # How duplicate MAP signals are recognised, see deduplicate_signals()
+ESCALATE_SEVERITIES = ("serious", "systematic")  # Triage signals with these re-run the chunk on MODEL_NAME
+ESCALATE_CONFIDENCES = ("low",)  # Same for signals the triage model isn't sure about
+PROCESS_POOL_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # For CPU-heavy work outside the event loop (dry-run planning)
+
+log = logging.getLogger("esg")
+
+
+
+# The Pydantic model, which make sure the data structured and formatted + data normalization
+class ESGResult(BaseModel):
+    company: str = ""
+    industry: str = ""
+    classification: str
+    reasoning: str
+    criteria_triggered: list = Field(default_factory=list)
+    key_evidence: list = Field(default_factory=list)
+    forward_looking_assessment: str = ""
+    coal_transition_timeline: str = ""
+    confidence_score: float = 0.0  # 0–100 confidence in final classification
+    flagged_lean: str = ""         # "Approved", "Excluded", or "Neutral" - mainly for "Flagged" cases
+    flagged_reasoning: str = ""    # Short explanation for Flagged cases
+
+    @_field_validator('classification')
+    def validate_classification(cls, v):
+        v = v.strip() if isinstance(v, str) else str(v)
+        if v not in ["Approved", "Flagged", "Excluded"]:
+            v_lower = v.lower()
+            if "excluded" in v_lower:
+                return "Excluded"
+            elif "flagged" in v_lower or "observation" in v_lower:
+                return "Flagged"
+            else:
+                return "Approved"
+        return v
+
+    @_field_validator('confidence_score')
+    def validate_confidence_score(cls, v):
+        # Making sure the confidence score is between 0-100.
+        try:
+            v = float(v)
+        except (TypeError, ValueError):
+            return 0.0
+        if v < 0:
+            return 0.0
+        if v > 100:
+            return 100.0
+        return v
+
+
+
+# The pipeline runs in background threads and worker processes, so it reports warnings through this sink instead of drawing on the page.
+_MESSAGE_SINK = contextvars.ContextVar("message_sink", default=None)
+
+
+def notify(msg: str, level: str = "warning"):
+    """Hand a pipeline warning/error to the job that is running, or log it if there is none."""
+    sink = _MESSAGE_SINK.get()
+    if sink is not None:
+        sink(level, msg)
+    elif level == "error":
+        log.error(msg)
+    else:
+        log.warning(msg)
+
+
+_PROCESS_POOL = None
+_PROCESS_POOL_LOCK = threading.Lock()
+
+
+def get_process_pool():
+    """
+    Process pool shared by everything in this process that needs one; created on first use.
+    Workers are started by a fork server (spawned where there is none), never forked from this process:
+    forking a threaded process (Streamlit, the job executor) can copy a held lock into the child and hang it.
+    Workers import the modules fresh, so they see the settings at their defaults (plus the environment).
+    """
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _PROCESS_POOL = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS,
+                                                mp_context=multiprocessing.get_context(method))
+        return _PROCESS_POOL
+
+
+# Count tokens using tiktoken (make sure it's installed)
+def count_tokens(text: str) -> int:
+    return len(TOK.encode(text))
+
+
+# Copy an upload to disk block by block, so the batch never holds all the PDF bytes in memory. 
+def spool_upload(fileobj, spool_dir=SPOOL_DIR):
+    """Write a file-like upload to spool_dir and return its path."""
+    os.makedirs(spool_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=spool_dir)
+    with os.fdopen(fd, "wb") as out:
+        if hasattr(fileobj, "seek"):
+            fileobj.seek(0)
+        shutil.copyfileobj(fileobj, out, SPOOL_BLOCK_BYTES)
+    return path
+
+
+# Hash a spooled PDF without reading it into memory in one go (used for the result cache). 
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(SPOOL_BLOCK_BYTES), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Remove potential weird formatting from extracted PDF text. 
+def clean_text(text: str) -> str:
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+# Read the raw text of every page + the PDF outline (used to tag the chunks with their report section).
+# Opening by path lets MuPDF read pages from disk instead of keeping a second in-memory copy of the file.
+def pdf_path_to_pages(pdf_path: str):
+    doc = fitz.open(pdf_path, filetype="pdf")
+    try:
+        pages = [p.get_text("text") for p in doc]
+        toc = doc.get_toc(simple=True)
+    finally:
+        doc.close()
+    return pages, toc
+
+
+def smart_chunk(text: str, target: int, overlap: int):
+    """
+    Paragraph-aware chunking, were we use: 
+    - Splits text into paragraphs.
+    - Groups paragraphs into chunks up to our "target" tokens (10k).
+    - If a single paragraph is <10k tokens, then split by tokens with overlaped tokens to keep context.
+    """
+    paragraphs = text.split('\n\n')
+    chunks, current_chunk, current_tokens = [], [], 0
+
+    for para in paragraphs:
+        para = para.strip()
+        if not para:
+            continue
+
+        para_tokens = count_tokens(para)
+
+        # If one paragraph alone is too big, split it by tokens
+        if para_tokens > target:
+            if current_chunk:
+                chunks.append('\n\n'.join(current_chunk))
+                current_chunk, current_tokens = [], 0
+
+            # hard-split the long paragraph using tiktoken
+            ids = TOK.encode(para)
+            i = 0
+            while i < len(ids):
+                j = min(i + target, len(ids))
+                chunks.append(TOK.decode(ids[i:j]))
+                if j >= len(ids):
+                    break
+                i = max(0, j - overlap)
+
+        # If adding this paragraph would overflow the current chunk, start a new chunk
+        elif current_tokens + para_tokens > target:
+            if current_chunk:
+                chunks.append('\n\n'.join(current_chunk))
+            current_chunk, current_tokens = [para], para_tokens
+            continue
+        else:
+            current_chunk.append(para)
+            current_tokens += para_tokens
+
+    # Add any remaining paragraphs as the last chunk
+    if current_chunk:
+        chunks.append('\n\n'.join(current_chunk))
+
+    return chunks or [text]
+
+
+def chunk_sections(sections, target: int, overlap: int, skip_low_yield=None):
+    """
+    Section-aware version of smart_chunk, returns chunks as {"text", "section", "action"} in MAP order:
+    - "skip" sections (see sections.py) are left out, unless that would leave nothing.
+    - Small neighbouring sections of the same kind share a chunk, big sections are split with smart_chunk.
+    - Each section's text starts with a "[Section: ...]" line, so MAP knows where the quote comes from.
+    - "priority" sections come first, then the unmatched ones, then "low".
+    skip_low_yield defaults to SKIP_LOW_YIELD_SECTIONS as it is when called.
+    """
+    if skip_low_yield is None:
+        skip_low_yield = SKIP_LOW_YIELD_SECTIONS
+    kept = [sec for sec in sections if not (skip_low_yield and sec["action"] == "skip") and sec["text"].strip()]
+    if not kept:
+        kept = [{**sec, "action": "normal"} for sec in sections if sec["text"].strip()]
+
+    chunks = []
+    for action in MAP_ORDER:
+        parts, titles, parts_tokens = [], [], 0
+        for sec in (s for s in kept if s["action"] == action or (action == "normal" and s["action"] == "skip")):
+            marker = f"[Section: {sec['title']}]"
+            body = clean_text(sec["text"])
+            text = f"{marker}\n\n{body}"
+            sec_tokens = count_tokens(text)
+            if parts and parts_tokens + sec_tokens > target:
+                chunks.append({"text": "\n\n".join(parts), "section": " | ".join(titles), "action": action})
+                parts, titles, parts_tokens = [], [], 0
+            if sec_tokens > target:
+                # Long section titles never squeeze the pieces down to nothing, and the overlap stays below the
+                # piece size (smart_chunk would never advance otherwise)
+                size = max(target - count_tokens(marker), target // 2, 1)
+                for piece in smart_chunk(body, size, min(overlap, size - 1)):
+                    chunks.append({"text": f"{marker}\n\n{piece}", "section": sec["title"], "action": action})
+                continue
+            parts.append(text)
+            titles.append(sec["title"])
+            parts_tokens += sec_tokens
+        if parts:
+            chunks.append({"text": "\n\n".join(parts), "section": " | ".join(titles), "action": action})
+    return chunks
+
+
+# Normalize formatting from the LLM 
+def parse_first_json(text: str, default=None):
+    """Extract the first valid JSON object from a model response (handles ```json fences)."""
+    if not text:
+        return default
+    s = text.strip()
+    # Strip a leading ``` or ```json fence, if present
+    s = re.sub(r'^\s*```(?:json)?', '', s, flags=re.IGNORECASE)
+    # Strip a trailing ``` fence, if present
+    s = re.sub(r'```?\s*$', '', s)
+    decoder = json.JSONDecoder()
+    for idx, ch in enumerate(s):
+        if ch in '{[':
+            try:
+                obj, _ = decoder.raw_decode(s[idx:])
+                return obj
+            except json.JSONDecodeError:
+                continue
+    return default
+
+# It helps avoid repeated signals before we run the REDUCE step.
+def dedup_key(signal, strategy=None):
+    """What two signals must share to count as duplicates (None for a signal without evidence)."""
+    e = (signal.get("evidence") or "").strip().lower()
+    if not e:
+        return None
+    strategy = strategy or DEDUP_STRATEGY
+    if strategy == "exact":
+        return " ".join(e.split())
+    if strategy == "criterion":
+        return str(signal.get("criterion", "")).lower(), e[:100]
+    return e[:100]
+
+
+def deduplicate_signals(signals, strategy=None):
+    """
+    Keep unique signals by normalized evidence. Strategies (DEDUP_STRATEGY by default):
+    "prefix" = first 100 chars, "exact" = the whole quote, "criterion" = first 100 chars per criterion.
+    """
+    if not signals:
+        return []
+    seen = set()
+    unique = []
+    for s in signals:
+        key = dedup_key(s, strategy)
+        if key is None:
+            continue
+        if key not in seen:
+            seen.add(key)
+            unique.append(s)
+    return unique
+
+
+# MAP answers look like {"signals": [{...}, {...}]}. While an answer is streamed, each signal object is handed on as
+# soon as its closing brace arrives, instead of waiting for the whole answer.
+class SignalStreamParser:
+    """Incremental parser for the "signals" array of a MAP answer. feed() returns the signals completed by a piece."""
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = None  # Next character to scan, once the array has started
+        self._depth = 0
+        self._start = None  # Where the current signal object starts
+        self._in_string = False
+        self._escape = False
+        self._done = False
+
+    def feed(self, piece):
+        self._buf += piece
+        if self._done:
+            return []
+        if self._pos is None:
+            m = re.search(r'"signals"\s*:\s*\[', self._buf)
+            if not m:
+                return []
+            self._pos = m.end()
+
+        found = []
+        buf, i = self._buf, self._pos
+        while i < len(buf):
+            c = buf[i]
+            i += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                if self._depth == 0:
+                    self._start = i - 1
+                self._depth += 1
+            elif c == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        obj = json.loads(buf[self._start:i])
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        found.append(obj)
+            elif c == "]" and self._depth == 0:
+                self._done = True
+                break
+        self._pos = i
+        return found
+
+
+# Custom error message, so we might know what went wrong if the LLM fails. 
+class RetryableHTTPError(Exception):
+    pass
+
+
+def _retry_after_seconds(resp: aiohttp.ClientResponse):
+    """Parse the Retry-After header from an aiohttp response."""
+    retry_after = resp.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    # Header can be either a delay in seconds or as an HTTP-date
+    try:
+        delay = int(retry_after)
+        return max(0, delay)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        dt = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        dt = None
+
+    if not dt:
+        return None
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return max(0, (dt - datetime.now(timezone.utc)).total_seconds())
+
+
+
+class CallStats:
+    """
+    Running totals of the LLM calls made in this process, per model and per tier ("map_triage", "map",
+    "map_escalated", "reduce"). Used for the dry-run estimates and the per-tier report.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_model = {}
+        self.by_tier = {}
+
+    def record(self, model, seconds, usage=None, tier=""):
+        usage = usage or {}
+        with self._lock:
+            for totals, name in ((self.by_model, model), (self.by_tier, tier or "other")):
+                s = totals.setdefault(name, {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+                s["calls"] += 1
+                s["seconds"] += seconds
+                s["prompt_tokens"] += int(usage.get("prompt_tokens") or 0)
+                s["completion_tokens"] += int(usage.get("completion_tokens") or 0)
+
+    def mean_latency(self, model, default=None):
+        with self._lock:
+            s = self.by_model.get(model)
+            return s["seconds"] / s["calls"] if s and s["calls"] else default
+
+    def snapshot(self, by="model"):
+        with self._lock:
+            totals = self.by_tier if by == "tier" else self.by_model
+            return {name: dict(s) for name, s in totals.items()}
+
+    def summary(self):
+        """One line per tier: calls and mean latency."""
+        return "; ".join(f"{tier}: {s['calls']} call(s), {s['seconds'] / s['calls']:.1f}s avg"
+                         for tier, s in sorted(self.snapshot("tier").items()))
+
+
+CALL_STATS = CallStats()
+
+
+# Read a streamed (server-sent events) answer. A stream that breaks off returns what arrived, with complete=False.
+async def _read_stream(resp, on_delta):
+    parts, usage, complete = [], None, False
+    try:
+        async for raw_line in resp.content:
+            line = raw_line.decode("utf-8", "ignore").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                complete = True
+                break
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            usage = event.get("usage") or usage
+            for choice in event.get("choices") or []:  # Azure sends events without choices (content filter results)
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+                if choice.get("finish_reason"):
+                    complete = True
+    except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        pass
+    return "".join(parts), usage, complete
+
+
+# Send our requests to the LLM, with retries if the server is busy (a common approach)
+async def llm_chat_async(messages, model, url, key, session, timeout=REQUEST_TIMEOUT_SEC, tier="", on_delta=None,
+                         keep_partial=None):
+    """
+    Low-level chat call with Azure compatibility and retries. tier only labels the call in CALL_STATS.
+    With on_delta the answer is streamed and on_delta(text) gets every piece as it arrives. If the stream breaks
+    off, the text received so far is returned when keep_partial() says it is usable (a retry would pay for the
+    whole answer again); otherwise the call is retried like a timeout.
+    """
+    is_azure = ("azure.com" in url.lower()) or ("openai.azure.com" in url.lower())
+    headers = {"Content-Type": "application/json"}
+
+    if is_azure:
+        payload = {"messages": messages, "max_completion_tokens": 10000}  # Max text output is 10000, more than enough. 
+        headers["api-key"] = key
+    else:
+        payload = {"model": model, "messages": messages, "max_tokens": 10000}
+        headers["Authorization"] = f"Bearer {key}"
+    if on_delta:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
+
+    max_retries = 5
+    for attempt in range(max_retries):
+        started = time.monotonic()
+        try:
+            async with session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
+                if resp.status in (429, 500, 502, 503, 504):
+                    if attempt < max_retries - 1:
+                        ra = _retry_after_seconds(resp)
+                        wait_time = ra if ra else min(2 ** attempt, 20)
+                        await asyncio.sleep(wait_time)
+                        continue
+                    raise RetryableHTTPError(f"HTTP {resp.status} after {max_retries} retries")
+                
+                if resp.status >= 400:
+                    txt = await resp.text()
+                    raise aiohttp.ClientError(f"HTTP {resp.status}: {txt[:200]}")
+                
+                if on_delta:
+                    content, usage, complete = await _read_stream(resp, on_delta)
+                    if not complete and not (content and keep_partial and keep_partial()):
+                        # Nothing usable arrived: retried like a timeout
+                        raise asyncio.TimeoutError(f"stream cut off after {len(content)} characters")
+                    if not complete:
+                        notify(f"Stream cut off after {len(content)} characters; keeping the partial answer")
+                    CALL_STATS.record(model, time.monotonic() - started, usage, tier)
+                    return content
+
+                data = await resp.json()
+                CALL_STATS.record(model, time.monotonic() - started, data.get("usage"), tier)
+                return data["choices"][0]["message"]["content"]
+        
+        except asyncio.TimeoutError:
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            raise
+    
+    raise RetryableHTTPError(f"Failed after {max_retries} attempts")
+
+
+# The core of our model: This sends ONE chunk of text to the LLM and asks it to extract ESG "signals". Use the prompt in "prompts.py". 
+# If none found it still sends a empty list so the chain don't break. A failed call also gives an empty list, marked "failed".
+# on_signal(signal) is called for every signal as soon as it is known (while streaming: as soon as it is complete).
+async def map_extract_signals_async(chunk, key, model, url, session, tier="map", on_signal=None):
+    msgs = [{"role": "system", "content": MAP_SYSTEM},
+            {"role": "user", "content": MAP_USER_PREFIX + chunk}]
+    streamed = []
+    parser = SignalStreamParser()
+
+    def on_delta(piece):
+        for s in parser.feed(piece):
+            streamed.append(s)
+            if on_signal:
+                on_signal(s)
+
+    def keep_partial():
+        # A cut-off stream is only kept if it gave at least one complete signal; else it is retried from scratch
+        nonlocal parser
+        if streamed:
+            return True
+        parser = SignalStreamParser()
+        return False
+
+    try:
+        raw = await llm_chat_async(msgs, model, url, key, session, tier=tier,
+                                   on_delta=on_delta if STREAM_RESPONSES else None, keep_partial=keep_partial)
+        out = parse_first_json(raw, default={"signals": []})
+        if not isinstance(out, dict) or "signals" not in out:
+            # A stream cut off after its first complete signal keeps the signals that were complete
+            out = {"signals": streamed}
+        if on_signal and not streamed:
+            for s in out["signals"]:
+                if isinstance(s, dict):
+                    on_signal(s)
+        return out
+    except aiohttp.ClientError as e:
+        # IF the provided content filter triggers (in the API call), like "war" mentions, return a special signal so the LLM can treat it as a soft flag essentially. 
+        msg = str(e).lower()
+        if "content" in msg and ("filter" in msg or "trigger" in msg):
+            notify("Content filter triggered during MAP")
+            return {"signals": [{"criterion": "content_filter_triggered", "evidence": "map"}]}
+        notify(f"MAP extraction failed: {str(e)[:100]}")
+        return {"signals": [], "failed": True}
+    except Exception as e:
+        notify(f"MAP extraction failed: {str(e)[:100]}")
+        return {"signals": [], "failed": True}
+
+
+def needs_escalation(signals):
+    """Whether the triage model's signals for a chunk should be checked by the main model."""
+    return any(
+        isinstance(s, dict) and (str(s.get("severity", "")).lower() in ESCALATE_SEVERITIES or
+                                 str(s.get("confidence", "")).lower() in ESCALATE_CONFIDENCES)
+        for s in signals
+    )
+
+
+# Most chunks come back empty, so the cheap model reads everything and the main model only the chunks that matter.
+# The main model's answer replaces the triage answer for an escalated chunk (it may also drop a false alarm).
+async def map_cascade_async(chunk, key, model, url, session, on_signal=None):
+    """
+    MAP for one chunk through the model cascade. Every signal is tagged with the model that produced it.
+    on_signal only gets the final answer's signals (triage signals that are escalated are never passed on).
+    A chunk the triage model failed on goes to the main model, so a broken triage tier never passes as "no signals".
+    """
+    def tagged(used):
+        return (lambda s: on_signal({**s, "model": used})) if on_signal else None
+
+    if not MAP_TRIAGE_MODEL:
+        out = await map_extract_signals_async(chunk, key, model, url, session, on_signal=tagged(model))
+        used = model
+    else:
+        out = await map_extract_signals_async(chunk, key, MAP_TRIAGE_MODEL, MAP_TRIAGE_URL or url, session, "map_triage")
+        used = MAP_TRIAGE_MODEL
+        if out.get("failed"):
+            notify(f"Triage model {MAP_TRIAGE_MODEL} failed on a chunk; running it on {model}")
+        if out.get("failed") or needs_escalation(out.get("signals", [])):
+            out = await map_extract_signals_async(chunk, key, model, url, session, "map_escalated", tagged(model))
+            used = model
+        elif on_signal:
+            for s in out.get("signals", []):
+                if isinstance(s, dict):
+                    on_signal({**s, "model": used})
+    return {**out, "signals": [{**s, "model": used} for s in out.get("signals", []) if isinstance(s, dict)]}
+
+
+# See the omment in the code
+async def process_chunks_parallel(chunks, key, model, url, max_concurrent, session, progress_callback=None, semaphore=None,
+                                  chunk_numbers=None, signal_callback=None):
+    """
+    Process multiple chunks at the same time, but never more than max_concurrent in parallel.
+    Pass a shared semaphore when several files run at once, so the limit holds for the whole batch.
+    chunk_numbers are the (1-based) numbers the signals are tagged with, when only some of a file's chunks are sent.
+    signal_callback(signal) gets each new (not duplicate) signal as soon as it is known, tagged with its chunk.
+    """
+    semaphore = semaphore or asyncio.Semaphore(max_concurrent)
+    chunk_numbers = chunk_numbers or list(range(1, len(chunks) + 1))
+    seen = set()
+
+    def live(chunk_num):
+        def on_signal(s):
+            s = {**s, "chunk": chunk_num}
+            key = dedup_key(s)
+            if key is not None and key not in seen:
+                seen.add(key)
+                signal_callback(s)
+        return on_signal if signal_callback else None
+
+    async def bounded_task(chunk, i, total):
+        async with semaphore:
+            if progress_callback:
+                progress_callback(f"Processing chunk {i}/{total}")
+            return await map_cascade_async(chunk, key, model, url, session, live(chunk_numbers[i - 1]))
+    
+    tasks = [bounded_task(chunk, i+1, len(chunks)) for i, chunk in enumerate(chunks)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    
+    # Filter out if a chunck failed and then adds ALL "signals" to a list. 
+    all_signals = []
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            notify(f"Chunk {i+1} failed: {str(result)[:100]}")
+            continue
+        if isinstance(result, dict) and "signals" in result:
+            # Remember which chunk each signal came from (kept in the per-chunk signals table)
+            all_signals.extend({**s, "chunk": chunk_numbers[i]} for s in result.get("signals", []) if isinstance(s, dict))
+    
+    return deduplicate_signals(all_signals)
+
+
+
+# If the company name is not found, use the file name. 
+def robust_name(v, fallback):
+    return v if v and v.strip() not in {"", "Unknown", "N/A"} else fallback
+
+
+# Same idea but here's it says Unknown Industry instead. 
+def robust_industry(v):
+    return v if v and v.strip().lower() not in {"", "unknown", "n/a"} else "Unknown Industry"
+
+
+# The combined signals is send to the second AI prompt to evaluate the final ESG classification. 
+async def reduce_classify_async(signals, fallback_company, doc_header, key, model, url, session):
+    msgs = [{"role": "system", "content": REDUCE_SYSTEM},
+            {"role": "user", "content": REDUCE_USER_PREFIX + f"{doc_header[:3000]}\n\n" +
+             REDUCE_USER_INSTRUCTIONS + json.dumps({"signals": signals}, ensure_ascii=False)}]
+    default = {
+        "company": fallback_company,
+        "industry": "Unknown Industry",
+        "classification": "Flagged",
+        "reasoning": "Fallback REDUCE result: parsing issue or incomplete model response. Manual review required.",
+        "criteria_triggered": ["Fallback_Review"],
+        "key_evidence": [],
+        "forward_looking_assessment": "",
+        "coal_transition_timeline": "",
+        "confidence_score": 0.0,
+        "flagged_lean": "",  # NEW field for direction if "Flagged"
+        "flagged_reasoning": ""
+    }
+    try:
+        raw = await llm_chat_async(msgs, REDUCE_MODEL or model, REDUCE_URL or url, key, session, tier="reduce")
+        out = parse_first_json(raw, default=default) or default
+
+        # IF any content filter tripped in MAP, that the LLM sometimes dont want to process --> force flagg it 
+        if any((isinstance(s, dict) and s.get("criterion") == "content_filter_triggered") for s in signals):
+            out["classification"] = "Flagged"
+            out["reasoning"] = (out.get("reasoning", "") +
+                                " Content filter triggered; manual review required.").strip()
+            out.setdefault("criteria_triggered", []).append("content_filter_triggered")
+
+        out["company"] = robust_name(out.get("company"), fallback_company)
+        out["industry"] = robust_industry(out.get("industry"))
+
+        # Validate/normalize final text output from the LLM
+        return ESGResult(**out).model_dump()
+    except Exception as e:
+        default["reasoning"] = f"REDUCE error: {str(e)[:150]}"
+        default.setdefault("confidence_score", 0.0)
+        return default
+
+
+# Everything before MAP (no LLM calls), shared by the real run and the dry-run planner. 
+def prepare_file(pdf_path):
+    """
+    Extract, tag sections, chunk and pre-compute the coal signals for one PDF. Plain function, so it can run
+    in a thread or in a worker process. map_numbers are the 1-based numbers of the chunks that need MAP.
+    """
+    pages, toc = pdf_path_to_pages(pdf_path)
+    ocr_report = {"pages": [], "seconds": {}, "cached": 0, "unavailable": 0}
+    warnings = []
+    if OCR_FALLBACK:
+        # Scanned pages get their text from OCR and then go through the same sections and chunking as the rest
+        pages, ocr_report = ocr_low_text_pages(pdf_path, pages, get_process_pool)
+        if ocr_report["unavailable"]:
+            warnings.append(f"{ocr_report['unavailable']} page(s) look scanned, but OCR is not available "
+                            f"(install pytesseract and tesseract)")
+    text = clean_text("\n".join(pages))
+
+    # Tag the text with report sections, leave out the low-yield ones and MAP the high-yield ones first
+    sections = split_sections(pages, toc)
+    section_chunks = chunk_sections(sections, CHUNK_TARGET_TOKENS, CHUNK_OVERLAP_TOKENS, SKIP_LOW_YIELD_SECTIONS) or [
+        {"text": text, "section": "", "action": "normal"}
+    ]
+    chunks = [c["text"] for c in section_chunks]
+    sections_skipped = sum(1 for sec in sections if SKIP_LOW_YIELD_SECTIONS and sec["action"] == "skip")
+
+    # Deterministic §3(2) coal numbers go straight to REDUCE; chunks that are only coal tables skip MAP
+    coal_presignals, map_numbers = [], list(range(1, len(chunks) + 1))
+    if COAL_PRESIGNALS:
+        try:
+            metrics = extract_coal_metrics(chunks)
+            coal_presignals = coal_signals(metrics)
+            if SKIP_MAP_FOR_COAL_TABLES:
+                map_numbers = [i + 1 for i, skip in enumerate(coal_table_mask(chunks, metrics)) if not skip]
+        except Exception as coal_err:
+            warnings.append(f"coal figure extraction failed: {str(coal_err)[:100]}")
+
+    return {
+        "pages": pages,
+        "text": text,
+        "section_chunks": section_chunks,
+        "chunks": chunks,
+        "sections_skipped": sections_skipped,
+        "coal_presignals": coal_presignals,
+        "map_numbers": map_numbers,
+        "ocr": ocr_report,
+        "warnings": warnings,
+    }
+
+
+# See code comment again 
+async def process_single_file_async(file_name, pdf_path, key, model, url, max_concurrent, session, status_callback=None, semaphore=None,
+                                    signals_callback=None, signal_callback=None):
+    """
+    Process a single PDF file (read from pdf_path on disk). signals_callback(file_name, signals) receives the deduplicated MAP signals,
+    signal_callback(file_name, signal) each MAP signal as soon as it is known (before REDUCE, evidence not yet verified).
+    """
+    started = time.monotonic()
+    first_signal_at = None
+
+    def on_signal(s):
+        nonlocal first_signal_at
+        if first_signal_at is None:
+            first_signal_at = time.monotonic() - started
+        if signal_callback:
+            signal_callback(file_name, s)
+
+    try:
+        if status_callback:
+            status_callback(f"Processing: {file_name}")
+        
+        prep = await asyncio.to_thread(prepare_file, pdf_path)  # Keep the event loop free for the other files
+        text, section_chunks, chunks = prep["text"], prep["section_chunks"], prep["chunks"]
+        sections_skipped, coal_presignals, map_numbers = prep["sections_skipped"], prep["coal_presignals"], prep["map_numbers"]
+        if len(text) < LOW_TEXT_THRESHOLD and not prep["ocr"]["pages"]:
+            # Scanned pages were either OCR'd or reported as such (in the warnings below); this is the other case
+            if OCR_FALLBACK:
+                notify(f"{file_name}: very little selectable text ({len(text)} characters), and no page looks scanned")
+            else:
+                notify(f"{file_name}: very little selectable text ({len(text)} characters); turn on OCR_FALLBACK "
+                       f"or run OCR first")
+        for warning in prep["warnings"]:
+            notify(f"{file_name}: {warning}")
+        ocr_seconds = prep["ocr"]["seconds"]
+        if ocr_seconds:
+            timings = ", ".join(f"p{page} {sec:.1f}s" for page, sec in ocr_seconds.items())
+            log.info(f"{file_name}: OCR per page: {timings}")
+            if status_callback:
+                status_callback(f"{file_name}: OCR'd {len(ocr_seconds)} scanned page(s) in {sum(ocr_seconds.values()):.1f}s "
+                                f"({prep['ocr']['cached']} from cache)")
+
+        if status_callback:
+            status_callback(f"{file_name}: {len(map_numbers)} Chunks are processed in parallel, according to set limits "
+                            f"({sections_skipped} low-yield section(s) and {len(chunks) - len(map_numbers)} coal table chunk(s) skipped)")
+
+        # The evidence index is built in a thread while MAP is waiting on the API
+        index_task = asyncio.ensure_future(asyncio.to_thread(EvidenceIndex, prep["pages"])) if VERIFY_EVIDENCE else None
+
+        # Run MAP at the same time, in parallel. Warns if there's an error. 
+        try:
+            signals = await process_chunks_parallel(
+                [chunks[n - 1] for n in map_numbers], key, model, url, max_concurrent, session,
+                lambda msg: status_callback(f"{file_name}: {msg}") if status_callback else None,
+                semaphore, map_numbers, on_signal
+            )
+        except Exception as async_err:
+            notify(f"Async processing error for {file_name}: {str(async_err)[:200]}", "error")
+            signals = []
+        # The LLM's own quote of the same sentence wins (it also has the forward-looking part)
+        signals = deduplicate_signals(signals + coal_presignals)
+        for s in signals:
+            s["section"] = section_chunks[s["chunk"] - 1]["section"]
+        unverified = verify_signals(signals, await index_task) if index_task else 0
+        if signals_callback:
+            signals_callback(file_name, signals)
+        reduce_signals = signals
+        if DROP_UNVERIFIED_SIGNALS and unverified:
+            # Content-filter markers have no real quote, but must still reach REDUCE
+            reduce_signals = [s for s in signals if s["verified"] or s.get("criterion") == "content_filter_triggered"]
+            notify(f"{file_name}: {unverified} signal(s) left out of REDUCE, evidence not found in the report")
+
+        # Create a short header for each company (start of the report in page order, whatever was MAPped first)
+        header = text[:3000]
+
+        # Run REDUCE (step 2), and build the final results (+CSV) from the LLM outputs. Also, catches any potential errors. 
+        try:
+            final = await reduce_classify_async(
+                reduce_signals, os.path.splitext(file_name)[0], header,
+                key, model, url, session
+            )
+        except Exception as reduce_err:
+            notify(f"Classification error for {file_name}: {str(reduce_err)[:200]}", "error")
+            final = {
+                "company": os.path.splitext(file_name)[0],
+                "industry": "Unknown Industry",
+                "classification": "Flagged",
+                "criteria_triggered": ["Processing_Error"],
+                "reasoning": f"Reduce phase error: {str(reduce_err)[:200]}",
+                "key_evidence": [],
+                "forward_looking_assessment": "",
+                "coal_transition_timeline": "",
+                "confidence_score": 0.0,
+                "flagged_lean": ""
+            }
+
+        return {
+            "file": file_name,
+            "company": final.get("company", ""),
+            "industry": final.get("industry", ""),
+            "classification": final.get("classification", ""),
+            "criteria_triggered": list(final.get("criteria_triggered", [])),
+            "reasoning": final.get("reasoning", ""),
+            "key_evidence": list(final.get("key_evidence", [])),
+            "forward_looking": final.get("forward_looking_assessment", ""),
+            "coal_transition": final.get("coal_transition_timeline", ""),
+            "chunks_processed": len(map_numbers),
+            "sections_skipped": sections_skipped,
+            "ocr_pages": len(ocr_seconds),
+            "ocr_seconds": round(sum(ocr_seconds.values()), 1),
+            "signals_found": len(signals),
+            "signals_unverified": unverified,
+            "first_signal_sec": round(first_signal_at, 2) if first_signal_at is not None else None,
+            "confidence_score": final.get("confidence_score", 0.0),
+            "flagged_lean": final.get("flagged_lean", ""),
+            "flagged_reasoning": final.get("flagged_reasoning", "")
+        }
+
+
+    except Exception as e:
+        return error_result(file_name, f"Processing error: {str(e)[:200]}")
+
+
+
+# Row used when a file could not be processed at all, so it still shows up in the output. 
+def error_result(file_name, reasoning):
+    return {
+        "file": file_name,
+        "company": os.path.splitext(file_name)[0],
+        "industry": "Unknown Industry",
+        "classification": "Flagged",
+        "criteria_triggered": ["Processing_Error"],
+        "reasoning": reasoning,
+        "key_evidence": [],
+        "forward_looking": "",
+        "coal_transition": "",
+        "chunks_processed": 0,
+        "sections_skipped": 0,
+        "ocr_pages": 0,
+        "ocr_seconds": 0.0,
+        "signals_found": 0,
+        "signals_unverified": 0,
+        "first_signal_sec": None,
+        "confidence_score": 0.0,
+        "flagged_lean": ""
+    }
+
+
+def is_error_result(row):
+    return "Processing_Error" in (row.get("criteria_triggered") or [])
+
+
+# Rows keep criteria_triggered and key_evidence as lists; CSV gets them joined the way the original export did. 
+def csv_row(row):
+    return {
+        **row,
+        "criteria_triggered": ", ".join(str(c) for c in row.get("criteria_triggered") or []),
+        "key_evidence": " | ".join(str(e) for e in row.get("key_evidence") or []),
+    }
+
+
+# One ClientSession per batch (or per worker process), sized for the parallel chunk requests. 
+def make_session(max_concurrent):
+    connector = aiohttp.TCPConnector(
+        limit=max_concurrent * 2,  # Allow enough connections for parallel chunks + we set an timeout for requests (safety)
+        limit_per_host=max_concurrent * 2,
+        force_close=False,
+        enable_cleanup_closed=True
+    )
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SEC * 2)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+# Settings prepare_file reads (extraction, OCR, sections, chunking, coal pre-signals). Read at call time, so a
+# changed setting (e.g. in the sweep) is seen by the cache keys; the planner hands them to its pool workers.
+PREPARE_SETTINGS = ("CHUNK_TARGET_TOKENS", "CHUNK_OVERLAP_TOKENS", "SKIP_LOW_YIELD_SECTIONS", "COAL_PRESIGNALS",
+                    "SKIP_MAP_FOR_COAL_TABLES", "OCR_FALLBACK")
+# Settings after MAP that change the result row
+RESULT_SETTINGS = ("DEDUP_STRATEGY", "VERIFY_EVIDENCE", "DROP_UNVERIFIED_SIGNALS", "ESCALATE_SEVERITIES",
+                   "ESCALATE_CONFIDENCES")
+
+
+def prepare_settings():
+    return {name: globals()[name] for name in PREPARE_SETTINGS}
+
+
+def settings_key(names):
+    return "|".join(f"{name}={globals()[name]!r}" for name in names)
+
+
+# Cached results are keyed on the PDF content and the settings that change the output, so renamed copies of a report are still a hit.
+def result_cache_key(content_hash: str, model: str) -> str:
+    return hashlib.sha256(
+        f"{content_hash}|{model}|{MAP_TRIAGE_MODEL}|{REDUCE_MODEL}|{settings_key(PREPARE_SETTINGS + RESULT_SETTINGS)}".encode("utf-8")
+    ).hexdigest()
+
+
+class ByteBudget:
+    """Async gate on the total size of the PDFs in flight. A file larger than the whole budget still runs, but alone."""
+
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.in_use = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, n):
+        n = min(n, self.limit)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_use + n <= self.limit)
+            self.in_use += n
+        return n
+
+    async def release(self, n):
+        async with self._cond:
+            self.in_use -= n
+            self._cond.notify_all()
+
+
+# We use the ClientSession to keep all API calls within the same session (also a common practice for efficiency). 
+async def process_all_files_async(file_list, key, model, url, max_concurrent,
+                                  status_callback=None, result_callback=None, cache=None,
+                                  max_inflight_bytes=MAX_INFLIGHT_BYTES, signals_callback=None, signal_callback=None):
+    """
+    Process the files of a batch using a shared ClientSession.
+    - file_list is a list of (file_name, pdf_path) with the PDFs already on disk (see spool_upload).
+    - Files are started in order for as long as their total size fits in max_inflight_bytes, so memory use
+      stays flat whatever the batch size. max_concurrent limits the MAP requests of the whole batch.
+    - result_callback(row) is called as soon as a file is finished, so the page can show rows incrementally.
+    - signals_callback(file_name, signals) receives the MAP signals of each file (also for cache hits).
+    - signal_callback(file_name, signal) receives each MAP signal live, while the file is still running.
+    - cache (dict) maps result_cache_key() -> (row, signals); hits skip the LLM calls completely.
+    Returns the rows in the same order as file_list.
+    """
+    budget = ByteBudget(max_inflight_bytes)
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    results = [None] * len(file_list)
+
+    def finish(i, result):
+        results[i] = result
+        if result_callback:
+            result_callback(result)  # Update the page after each file processed
+
+    async def run_one(i, file_name, pdf_path, cache_key, reserved):
+        file_signals = []
+
+        def on_signals(name, signals):
+            file_signals.extend(signals)
+            if signals_callback:
+                signals_callback(name, signals)
+
+        try:
+            result = await process_single_file_async(
+                file_name, pdf_path, key, model, url, max_concurrent, session,
+                status_callback, semaphore, on_signals, signal_callback
+            )
+            # Only cache clean results, so failed files are retried on the next run
+            if cache_key is not None and not is_error_result(result):
+                cache[cache_key] = (result, file_signals)
+        except Exception as e:  # IF an error happen to an individual file, still produce/include it in the output.  
+            result = error_result(file_name, f"Unexpected error: {str(e)[:200]}")
+        finally:
+            await budget.release(reserved)
+        finish(i, result)
+
+    async with make_session(max_concurrent) as session:
+        tasks = []
+        for i, (file_name, pdf_path) in enumerate(file_list):
+            try:
+                cache_key = None
+                if cache is not None:
+                    cache_key = result_cache_key(await asyncio.to_thread(file_sha256, pdf_path), model)
+                if cache_key is not None and cache_key in cache:
+                    cached_row, cached_signals = cache[cache_key]
+                    if status_callback:
+                        status_callback(f"{file_name}: cached result reused")
+                    if signals_callback:
+                        signals_callback(file_name, cached_signals)
+                    finish(i, {**cached_row, "file": file_name})
+                    continue
+                # Wait here until enough of the earlier files are done, then start this one
+                reserved = await budget.acquire(os.path.getsize(pdf_path))
+            except Exception as e:
+                finish(i, error_result(file_name, f"Unexpected error: {str(e)[:200]}"))
+                continue
+            tasks.append(asyncio.create_task(run_one(i, file_name, pdf_path, cache_key, reserved)))
+
+        await asyncio.gather(*tasks)
+    
+    return results  # List of the results
@@ -0,0 +1,185 @@
+"""
+Dry-run planner: runs the pipeline up to MAP (extraction, sections, chunking, coal pre-signals) for a batch,
+without any LLM calls, and projects the calls, tokens, cost and wall-clock time of the real run.
+
+Extraction runs in the shared process pool; files with a cached result cost nothing. Calls are priced per model
+tier (MAP triage, escalated MAP, REDUCE). Latency comes from the calls measured in this process (CALL_STATS)
+once there are any, otherwise from DEFAULT_CALL_LATENCY_SEC.
+"""
+
+import time
+
+import pipeline
+from prompts import (
+    MAP_SYSTEM,
+    MAP_USER_PREFIX,
+    REDUCE_SYSTEM,
+    REDUCE_USER_PREFIX,
+    REDUCE_USER_INSTRUCTIONS
+)
+from pipeline import (
+    CALL_STATS,
+    MAP_TRIAGE_MODEL,
+    PREPARE_SETTINGS,
+    REDUCE_MODEL,
+    count_tokens,
+    file_sha256,
+    get_process_pool,
+    prepare_file,
+    prepare_settings,
+    result_cache_key,
+    settings_key
+)
+
+# Assumptions for what can't be counted before the run
+EST_MAP_OUTPUT_TOKENS = 150  # Most chunks come back as {"signals": []}
+EST_REDUCE_OUTPUT_TOKENS = 800
+EST_SIGNALS_PER_FILE = 8  # MAP signals reaching REDUCE, on top of the pre-computed coal signals
+EST_TOKENS_PER_SIGNAL = 120
+EST_ESCALATION_RATE = 0.15  # Share of MAP chunks the triage model passes on to the main model (model cascade only)
+DEFAULT_CALL_LATENCY_SEC = 20.0
+MESSAGE_OVERHEAD_TOKENS = 4  # Per chat message (role + separators)
+
+MODEL_PRICES_PER_1M = {"gpt-5-mini": (0.25, 2.00), "gpt-5-nano": (0.05, 0.40), "gpt-5": (1.25, 10.00)}  # USD per 1M (input, output) tokens; unknown models cost 0
+REQUESTS_PER_MINUTE = None  # API rate limit, if the provider has one
+TOKEN_BUDGET_PER_RUN = None  # Input + output tokens per batch; None = no budget
+BUDGET_MODE = "downscope"  # "downscope" = run the files that fit (in upload order), "abort" = run nothing
+
+_PLAN_CACHE = {}  # file hash + prepare settings -> per-file plan (re-planning the same reports is instant)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def _fixed_tokens():
+    """Prompt tokens every MAP / REDUCE call pays regardless of the report."""
+    map_fixed = count_tokens(MAP_SYSTEM) + count_tokens(MAP_USER_PREFIX) + 2 * MESSAGE_OVERHEAD_TOKENS
+    reduce_fixed = (count_tokens(REDUCE_SYSTEM) + count_tokens(REDUCE_USER_PREFIX) +
+                    count_tokens(REDUCE_USER_INSTRUCTIONS) + 2 * MESSAGE_OVERHEAD_TOKENS)
+    return map_fixed, reduce_fixed
+
+
+def _cost(model, input_tokens, output_tokens):
+    price_in, price_out = MODEL_PRICES_PER_1M.get(model, (0.0, 0.0))
+    return (input_tokens * price_in + output_tokens * price_out) / 1_000_000
+
+
+def _plan_file(args):
+    """Runs in a worker process: token counts for one PDF (only numbers go back, not the text)."""
+    pdf_path, settings = args
+    for name, value in settings.items():  # The worker imported pipeline with the defaults
+        setattr(pipeline, name, value)
+    prep = prepare_file(pdf_path)
+    return {
+        "pages": len(prep["pages"]),
+        "ocr_pages": len(prep["ocr"]["pages"]),
+        "chunks": len(prep["chunks"]),
+        "map_calls": len(prep["map_numbers"]),
+        "chunk_tokens": sum(count_tokens(prep["chunks"][n - 1]) for n in prep["map_numbers"]),
+        "header_tokens": count_tokens(prep["text"][:3000]),
+        "coal_presignals": len(prep["coal_presignals"]),
+        "sections_skipped": prep["sections_skipped"],
+    }
+
+
+def plan_batch(file_list, model, max_concurrent, cache=None, requests_per_minute=REQUESTS_PER_MINUTE):
+    """
+    Dry run for a batch of (file_name, pdf_path). Returns {"files": [per-file rows], "totals": {...}}.
+    Token figures are input (prompt) and estimated output tokens of the real run.
+    """
+    started = time.monotonic()
+    map_fixed, reduce_fixed = _fixed_tokens()
+    triage_model, reduce_model = MAP_TRIAGE_MODEL or model, REDUCE_MODEL or model
+    escalation = EST_ESCALATION_RATE if MAP_TRIAGE_MODEL else 0.0
+
+    hashes = [file_sha256(path) for _, path in file_list]
+    settings = prepare_settings()
+    keys = [f"{h}|{settings_key(PREPARE_SETTINGS)}" for h in hashes]
+    todo = {k: path for k, (_, path) in zip(keys, file_list) if k not in _PLAN_CACHE}
+    if todo:
+        for k, plan in zip(todo, get_process_pool().map(_plan_file, [(path, settings) for path in todo.values()])):
+            _PLAN_CACHE[k] = plan
+
+    rows = []
+    for (file_name, _), h, k in zip(file_list, hashes, keys):
+        p = _PLAN_CACHE[k]
+        cached = cache is not None and result_cache_key(h, model) in cache
+        map_input = p["map_calls"] * map_fixed + p["chunk_tokens"]
+        map_output = p["map_calls"] * EST_MAP_OUTPUT_TOKENS
+        reduce_input = (reduce_fixed + p["header_tokens"] +
+                        (EST_SIGNALS_PER_FILE + p["coal_presignals"]) * EST_TOKENS_PER_SIGNAL)
+        # (model, calls, input tokens, output tokens) per tier; escalations re-send the same chunks
+        tiers = [] if cached else [
+            (triage_model, p["map_calls"], map_input, map_output),
+            (model, p["map_calls"] * escalation, map_input * escalation, map_output * escalation),
+            (reduce_model, 1, reduce_input, EST_REDUCE_OUTPUT_TOKENS),
+        ]
+        rows.append({
+            "file": file_name,
+            "pages": p["pages"],
+            "ocr_pages": p["ocr_pages"],
+            "chunks": p["chunks"],
+            "map_calls": 0 if cached else p["map_calls"],
+            "sections_skipped": p["sections_skipped"],
+            "cached": cached,
+            "calls": round(sum(t[1] for t in tiers)),
+            "input_tokens": round(sum(t[2] for t in tiers)),
+            "fixed_prompt_tokens": 0 if cached else round(p["map_calls"] * (1 + escalation) * map_fixed + reduce_fixed),
+            "output_tokens_est": round(sum(t[3] for t in tiers)),
+            "cost_usd_est": round(sum(_cost(m, i, o) for m, _, i, o in tiers), 4),
+            "call_sec_est": sum(n * CALL_STATS.mean_latency(m, DEFAULT_CALL_LATENCY_SEC) for m, n, _, _ in tiers),
+        })
+
+    calls = sum(r["calls"] for r in rows)
+    input_tokens = sum(r["input_tokens"] for r in rows)
+    output_tokens = sum(r["output_tokens_est"] for r in rows)
+    call_sec = sum(r.pop("call_sec_est") for r in rows)
+    latency = call_sec / calls if calls else CALL_STATS.mean_latency(model, DEFAULT_CALL_LATENCY_SEC)
+    extraction_sec = time.monotonic() - started
+    # Calls run max_concurrent at a time (or as fast as the rate limit allows); the last REDUCE adds one more latency
+    api_sec = call_sec / max_concurrent
+    if requests_per_minute:
+        api_sec = max(api_sec, calls * 60 / requests_per_minute)
+    if calls:
+        api_sec += CALL_STATS.mean_latency(reduce_model, DEFAULT_CALL_LATENCY_SEC)
+
+    return {
+        "files": rows,
+        "totals": {
+            "files": len(rows),
+            "cached_files": sum(r["cached"] for r in rows),
+            "calls": calls,
+            "input_tokens": input_tokens,
+            "output_tokens_est": output_tokens,
+            "total_tokens_est": input_tokens + output_tokens,
+            "fixed_prompt_tokens": sum(r["fixed_prompt_tokens"] for r in rows),
+            "cost_usd_est": round(sum(r["cost_usd_est"] for r in rows), 4),
+            "latency_per_call_sec": round(latency, 2),
+            "extraction_sec": round(extraction_sec, 1),
+            "est_wall_clock_sec": round(extraction_sec + api_sec, 1),
+        },
+    }
+
+
+def apply_budget(plan, budget=TOKEN_BUDGET_PER_RUN, mode=BUDGET_MODE):
+    """
+    How many files (from the start of the batch, in upload order) fit in the token budget.
+    Raises BudgetExceeded in "abort" mode, or when not even the first file fits.
+    """
+    if not budget or plan["totals"]["total_tokens_est"] <= budget:
+        return len(plan["files"])
+    if mode == "abort":
+        raise BudgetExceeded(
+            f"Estimated {plan['totals']['total_tokens_est']:,} tokens is over the budget of {budget:,}"
+        )
+    n, used = 0, 0
+    for r in plan["files"]:
+        tokens = r["input_tokens"] + r["output_tokens_est"]
+        if used + tokens > budget:
+            break
+        n += 1
+        used += tokens
+    if not n:
+        raise BudgetExceeded(f"The first file alone is over the token budget of {budget:,}")
+    return n
@@ -0,0 +1,190 @@
+"""
+Recorded-response replay server for the chat API, so pipeline runs (and parameter sweeps) are deterministic and
+offline. Point the pipeline's URL at it instead of the real endpoint.
+
+Every request is keyed on a hash of its model and messages, and the response is stored as one JSON file per key
+("cassette") together with the measured latency.
+- "record": known requests are replayed, new ones are forwarded to the real API and stored
+- "replay": known requests are replayed, new ones get HTTP 404 (counted as misses, nothing leaves the machine)
+Replayed responses wait for the recorded latency times latency_scale (0 = answer at once), so concurrency
+settings still behave like against the real API.
+
+Requests with "stream": true get the answer as server-sent events, spread over the same latency. With
+cut_streams_at (a fraction) every stream is dropped part-way, to test how partial answers are handled.
+
+Run: python3 replay_server.py --mode replay --cassettes replay_cassettes --port 8765
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import argparse
+import aiohttp
+from aiohttp import web
+
+DEFAULT_CASSETTE_DIR = os.environ.get("ESG_REPLAY_DIR", "replay_cassettes")
+CHAT_PATH = "/v1/chat/completions"
+STREAM_PIECE_CHARS = 16  # Characters per streamed delta (roughly a few tokens)
+
+
+def request_key(payload):
+    """Hash of what decides the answer (model and messages), not of limits like max_tokens."""
+    canonical = json.dumps({"model": payload.get("model", ""), "messages": payload.get("messages", [])},
+                           sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CassetteStore:
+    """One JSON file per request key, in subfolders by the first two hex digits."""
+
+    def __init__(self, root=DEFAULT_CASSETTE_DIR):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, record):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+async def _forward(session, upstream_url, upstream_key, payload):
+    """Send the request to the real API, in its own format (Azure has the model in the URL)."""
+    if "azure.com" in upstream_url.lower():
+        body = {"messages": payload["messages"], "max_completion_tokens": payload.get("max_tokens", 10000)}
+        headers = {"Content-Type": "application/json", "api-key": upstream_key}
+    else:
+        body = {k: v for k, v in payload.items() if k not in ("stream", "stream_options")}  # Recorded as a whole
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {upstream_key}"}
+    async with session.post(upstream_url, headers=headers, json=body) as resp:
+        return resp.status, await resp.text()
+
+
+async def chat(request):
+    app = request.app
+    payload = await request.json()
+    key = request_key(payload)
+    stats = app["stats"]
+
+    record = app["store"].get(key)
+    if record is not None:
+        stats["hits"] += 1
+        delay = record.get("latency_sec", 0.0) * app["latency_scale"]
+    elif app["mode"] != "record":
+        stats["misses"] += 1
+        return web.json_response({"error": {"message": f"No recorded response for request {key[:12]}"}}, status=404)
+    else:
+        started = time.monotonic()
+        status, text = await _forward(app["session"], app["upstream_url"], app["upstream_key"], payload)
+        if status != 200:
+            # Rate limits and errors are passed on (the pipeline retries), but never recorded
+            return web.Response(status=status, text=text, content_type="application/json")
+        record = {"model": payload.get("model", ""), "latency_sec": time.monotonic() - started,
+                  "response": json.loads(text)}
+        app["store"].put(key, record)
+        stats["recorded"] += 1
+        delay = 0.0  # The real API has already taken its time
+
+    if payload.get("stream"):
+        return await _stream(request, record["response"], delay, app["cut_streams_at"])
+    if delay:
+        await asyncio.sleep(delay)
+    return web.json_response(record["response"])
+
+
+def _sse(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def _stream(request, response, delay, cut_at=None):
+    """Send a recorded answer as chat-completion chunks, in pieces spread over delay seconds."""
+    content = response["choices"][0]["message"].get("content") or ""
+    pieces = [content[i:i + STREAM_PIECE_CHARS] for i in range(0, len(content), STREAM_PIECE_CHARS)] or [""]
+    if cut_at is not None:
+        pieces = pieces[:int(len(pieces) * cut_at)]
+
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await resp.prepare(request)
+    for piece in pieces:
+        if delay:
+            await asyncio.sleep(delay / len(pieces))
+        await resp.write(_sse({"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}))
+    if cut_at is not None:
+        request.transport.close()  # Drop the connection mid-answer, like a network failure
+        return resp
+    await resp.write(_sse({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+    if response.get("usage"):
+        await resp.write(_sse({"choices": [], "usage": response["usage"]}))
+    await resp.write(b"data: [DONE]\n\n")
+    await resp.write_eof()
+    return resp
+
+
+async def get_stats(request):
+    return web.json_response(request.app["stats"])
+
+
+async def _open_session(app):
+    app["session"] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+    yield
+    await app["session"].close()
+
+
+def make_app(cassette_dir=DEFAULT_CASSETTE_DIR, mode="replay", upstream_url="", upstream_key="", latency_scale=1.0,
+             cut_streams_at=None):
+    if mode not in ("record", "replay"):
+        raise ValueError(f"Unknown mode: {mode}")
+    if mode == "record" and not upstream_url:
+        raise ValueError("Record mode needs the upstream API URL")
+    app = web.Application(client_max_size=64 * 1024 ** 2)
+    app["store"] = CassetteStore(cassette_dir)
+    app["mode"] = mode
+    app["upstream_url"] = upstream_url
+    app["upstream_key"] = upstream_key
+    app["latency_scale"] = latency_scale
+    app["cut_streams_at"] = cut_streams_at
+    app["stats"] = {"hits": 0, "misses": 0, "recorded": 0}
+    app.cleanup_ctx.append(_open_session)
+    app.router.add_post(CHAT_PATH, chat)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+async def start_server(app, host="127.0.0.1", port=0):
+    """Run the app inside the current event loop. Returns (runner, chat URL); call runner.cleanup() when done."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}{CHAT_PATH}"
+
+
+if __name__ == "__main__":
+    from pipeline import API_KEY, API_URL
+
+    parser = argparse.ArgumentParser(description="Record / replay server for the chat API")
+    parser.add_argument("--mode", choices=("record", "replay"), default="replay")
+    parser.add_argument("--cassettes", default=DEFAULT_CASSETTE_DIR, help="Folder with the recorded responses")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplier on the recorded latency (0 = none)")
+    parser.add_argument("--cut-streams-at", type=float, default=None,
+                        help="Drop every streamed answer after this fraction of it (to test partial answers)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    web.run_app(make_app(args.cassettes, args.mode, API_URL, API_KEY, args.latency_scale, args.cut_streams_at),
+                host=args.host, port=args.port)
@@ -0,0 +1,187 @@
+"""
+Columnar result store: results and MAP signals are appended to Parquet while a run is going, partitioned by run.
+
+Layout (hive style, so every run can be read back as one dataset with a run_id column):
+    <root>/results/run_id=<run_id>/part-<...>.parquet
+    <root>/signals/run_id=<run_id>/part-<...>.parquet
+
+criteria_triggered and key_evidence are real list columns, not " | "-joined strings.
+"""
+
+import os
+import io
+import json
+import time
+import uuid
+import threading
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DEFAULT_RESULTS_DIR = os.environ.get("ESG_RESULTS_DIR", "results")
+FLUSH_EVERY_ROWS = 25  # Result rows buffered before a part file is written (signals are flushed at the same time)
+
+RESULTS_SCHEMA = pa.schema([
+    ("file", pa.string()),
+    ("company", pa.string()),
+    ("industry", pa.string()),
+    ("classification", pa.string()),
+    ("criteria_triggered", pa.list_(pa.string())),
+    ("reasoning", pa.string()),
+    ("key_evidence", pa.list_(pa.string())),
+    ("forward_looking", pa.string()),
+    ("coal_transition", pa.string()),
+    ("chunks_processed", pa.int32()),
+    ("sections_skipped", pa.int32()),
+    ("ocr_pages", pa.int32()),
+    ("ocr_seconds", pa.float64()),
+    ("signals_found", pa.int32()),
+    ("signals_unverified", pa.int32()),
+    ("first_signal_sec", pa.float64()),  # Time from the start of the file to its first MAP signal
+    ("confidence_score", pa.float64()),
+    ("flagged_lean", pa.string()),
+    ("flagged_reasoning", pa.string()),
+    ("finished_at", pa.timestamp("s", tz="UTC")),
+])
+
+SIGNALS_SCHEMA = pa.schema([
+    ("file", pa.string()),
+    ("chunk", pa.int32()),
+    ("section", pa.string()),
+    ("criterion", pa.string()),
+    ("evidence", pa.string()),
+    ("severity", pa.string()),
+    ("confidence", pa.string()),
+    ("quantitative_data", pa.string()),
+    ("forward_looking", pa.string()),
+    ("source", pa.string()),  # "coal_metrics" for the pre-computed coal signals, empty for MAP
+    ("model", pa.string()),  # Model that produced the signal (triage or main model), empty for coal_metrics
+    ("page", pa.int32()),  # Page the evidence was found on (evidence_index.py), null if not found
+    ("verified", pa.bool_()),
+])
+
+
+def _as_str(v):
+    """The LLM sometimes returns numbers or objects where we expect text."""
+    if v is None:
+        return ""
+    if isinstance(v, str):
+        return v
+    return json.dumps(v, ensure_ascii=False)
+
+
+def _as_int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _result_record(row):
+    rec = {}
+    for field in RESULTS_SCHEMA:
+        v = row.get(field.name)
+        if pa.types.is_list(field.type):
+            rec[field.name] = [_as_str(x) for x in (v or [])]
+        elif pa.types.is_integer(field.type):
+            rec[field.name] = _as_int(v)
+        elif pa.types.is_floating(field.type):
+            rec[field.name] = _as_float(v)
+        elif pa.types.is_timestamp(field.type):
+            rec[field.name] = datetime.fromtimestamp(v if v is not None else time.time(), tz=timezone.utc)
+        else:
+            rec[field.name] = _as_str(v)
+    return rec
+
+
+def _signal_record(file_name, signal):
+    rec = {
+        "file": file_name,
+        "chunk": _as_int(signal.get("chunk")),
+        "page": _as_int(signal.get("page")),
+        "verified": signal.get("verified"),
+    }
+    for field in SIGNALS_SCHEMA:
+        if field.name not in rec:
+            rec[field.name] = _as_str(signal.get(field.name))
+    return rec
+
+
+class ResultStore:
+    """
+    Buffers rows of one run and writes them as Parquet part files. Safe to call from several threads;
+    several processes can write the same run as well, since every part file gets a unique name.
+    """
+
+    def __init__(self, root=DEFAULT_RESULTS_DIR, run_id=None, flush_every=FLUSH_EVERY_ROWS):
+        self.root = root
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.flush_every = flush_every
+        self._results = []
+        self._signals = []
+        self._lock = threading.Lock()
+
+    def add_result(self, row):
+        with self._lock:
+            self._results.append(_result_record(row))
+            full = len(self._results) >= self.flush_every
+        if full:
+            self.flush()
+
+    def add_signals(self, file_name, signals):
+        with self._lock:
+            self._signals.extend(_signal_record(file_name, s) for s in signals if isinstance(s, dict))
+
+    def flush(self):
+        with self._lock:
+            results, self._results = self._results, []
+            signals, self._signals = self._signals, []
+        self._write("results", results, RESULTS_SCHEMA)
+        self._write("signals", signals, SIGNALS_SCHEMA)
+
+    def close(self):
+        self.flush()
+
+    def _write(self, table_name, records, schema):
+        if not records:
+            return
+        part_dir = os.path.join(self.root, table_name, f"run_id={self.run_id}")
+        os.makedirs(part_dir, exist_ok=True)
+        name = f"part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(part_dir, f".{name}.tmp")
+        pq.write_table(pa.Table.from_pylist(records, schema=schema), tmp_path)
+        os.replace(tmp_path, os.path.join(part_dir, name))  # Readers never see a half-written file
+
+
+def open_dataset(root=DEFAULT_RESULTS_DIR, table_name="results"):
+    """All runs of one table as a pyarrow dataset (filter on run_id, join results and signals on file)."""
+    schema = RESULTS_SCHEMA if table_name == "results" else SIGNALS_SCHEMA
+    return ds.dataset(
+        os.path.join(root, table_name), format="parquet",
+        schema=schema.append(pa.field("run_id", pa.string())),
+        partitioning=ds.partitioning(pa.schema([("run_id", pa.string())]), flavor="hive")
+    )
+
+
+def load_run(run_id, root=DEFAULT_RESULTS_DIR, table_name="results"):
+    """One run of one table as an Arrow table (empty if nothing has been written yet)."""
+    schema = RESULTS_SCHEMA if table_name == "results" else SIGNALS_SCHEMA
+    if not os.path.isdir(os.path.join(root, table_name, f"run_id={run_id}")):
+        return schema.empty_table()
+    table = open_dataset(root, table_name).to_table(filter=ds.field("run_id") == run_id)
+    return table.select(schema.names)
+
+
+def parquet_bytes(table):
+    """Serialize an Arrow table to Parquet, for download buttons and HTTP responses."""
+    buf = io.BytesIO()
+    pq.write_table(table, buf)
+    return buf.getvalue()
@@ -0,0 +1,106 @@
+"""
+Section rules for the text extraction.
+
+Each page of a report is tagged with the section it belongs to, from the PDF outline (doc.get_toc()) or, when
+there is none, from headings at the top of the pages. The rules below then decide per section:
+- "skip":     not sent to MAP at all (low-yield boilerplate)
+- "priority": MAPped first, since this is where the decisive signals usually are
+- "low":      MAPped last
+Sections that match no rule are MAPped between "priority" and "low". Edit the lists to change the behaviour.
+"""
+
+import re
+
+# Checked in this order against the section title (the most specific title first, then its parents)
+SECTION_RULES = [
+    ("skip", r"auditor'?s'?\s+report|report\s+of\s+(the\s+)?independent\s+(registered\s+public\s+accounting\s+firm|auditors?)"),
+    ("skip", r"(significant|material)?\s*accounting\s+policies|basis\s+of\s+preparation"),
+    ("skip", r"share\s*(holder)?\s*register|largest\s+shareholders|shareholder\s+information|shares\s+held\s+by"),
+    ("priority", r"risks?\b|risk\s+factors|principal\s+risks"),
+    ("priority", r"sustainab|\besg\b|climate|environment|emissions|corporate\s+responsibility"),
+    ("priority", r"legal\s+proceedings|litigation|contingen|investigations?"),
+    ("priority", r"segment"),
+    ("priority", r"human\s+rights|health\s+and\s+safety|anti-?corruption|ethics|compliance"),
+    ("low", r"glossary|definitions|abbreviations|financial\s+calendar|contact\s+information"),
+]
+
+MAP_ORDER = ("priority", "normal", "low")  # "skip" sections are left out
+
+_COMPILED_RULES = [(action, re.compile(pattern, re.IGNORECASE)) for action, pattern in SECTION_RULES]
+_HEADING_LINES_PER_PAGE = 3  # Only the top lines of a page are checked for a heading (fallback without outline)
+_MAX_HEADING_CHARS = 80
+
+
+def section_action(path):
+    """Action for a section given its title path, e.g. ["Notes", "1 Accounting policies"]."""
+    for title in reversed(path):
+        for action, rx in _COMPILED_RULES:
+            if rx.search(title):
+                return action
+    return "normal"
+
+
+def _looks_like_heading(line):
+    line = line.strip()
+    if not line or len(line) > _MAX_HEADING_CHARS or line.endswith((".", ",", ";")):
+        return False
+    if not re.search(r"[A-Za-z]{3}", line):
+        return False
+    # Either a known section name, or an all-caps title line
+    return any(rx.search(line) for _, rx in _COMPILED_RULES) or (line.isupper() and len(line.split()) <= 8)
+
+
+def page_sections(toc, pages):
+    """
+    Title path of the section each page belongs to (a list of lists, one per page).
+    toc is doc.get_toc() ([level, title, page] with 1-based pages); without one, headings are guessed from the pages.
+    """
+    n = len(pages)
+    result = [[] for _ in range(n)]
+
+    entries = [(lvl, title.strip(), page) for lvl, title, page, *_ in (toc or []) if 1 <= page <= n and title.strip()]
+    if entries:
+        stack = []  # (level, title) of the current path
+        starts = {}  # page index -> paths of the entries starting on that page
+        for lvl, title, page in entries:
+            while stack and stack[-1][0] >= lvl:
+                stack.pop()
+            stack.append((lvl, title))
+            starts.setdefault(page - 1, []).append([t for _, t in stack])
+        current = []
+        for i in range(n):
+            paths = starts.get(i)
+            if paths:
+                # A page where several sections start belongs to the first one that has text of its own
+                # (a parent followed by its child is one heading) and is not skipped, so a skip rule never
+                # hides the text of a kept section on the same page. The pages after it belong to the last one.
+                own = [p for p, nxt in zip(paths, paths[1:] + [None]) if nxt is None or nxt[:len(p)] != p]
+                result[i] = next((p for p in own if section_action(p) != "skip"), own[0])
+                current = paths[-1]
+            else:
+                result[i] = current
+        return result
+
+    current = []
+    for i, page in enumerate(pages):
+        top_lines = [l for l in page.split("\n") if l.strip()][:_HEADING_LINES_PER_PAGE]
+        heading = next((l.strip() for l in top_lines if _looks_like_heading(l)), None)
+        if heading:
+            current = [heading]
+        result[i] = current
+    return result
+
+
+def split_sections(pages, toc):
+    """
+    Group consecutive pages of the same section.
+    Returns a list of {"title", "action", "first_page", "text"} in document order (first_page is 1-based).
+    """
+    sections = []
+    for i, (page, path) in enumerate(zip(pages, page_sections(toc, pages))):
+        title = " > ".join(path) if path else "Front matter"
+        if sections and sections[-1]["title"] == title:
+            sections[-1]["text"] += "\n" + page
+            continue
+        sections.append({"title": title, "action": section_action(path), "first_page": i + 1, "text": page})
+    return sections
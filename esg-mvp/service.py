@@ -0,0 +1,135 @@
+"""
+HTTP service in front of the job queue. The service only stores uploads and queue rows; the LLM work is done
+by any number of worker processes (worker.py) pulling from the same queue.
+
+    POST /jobs                      multipart upload with one or more PDFs -> {"job_id": ...}
+    GET  /jobs/{job_id}             progress (task counts per status)
+    GET  /jobs/{job_id}/results     rows finished so far as JSON (?format=csv or ?format=parquet for a file)
+    GET  /jobs/{job_id}/signals     per-chunk MAP signals as Parquet
+
+Run: python3 service.py --port 8080 --db esg_queue.db --uploads uploads
+"""
+
+import os
+import io
+import uuid
+import hashlib
+import argparse
+from aiohttp import web
+import pandas as pd
+
+from job_queue import JobQueue, DEFAULT_DB_PATH, DEFAULT_UPLOAD_DIR
+from pipeline import csv_row
+from result_store import DEFAULT_RESULTS_DIR, load_run, parquet_bytes
+
+MAX_UPLOAD_BYTES = 2 * 1024 ** 3  # Per request, the whole batch
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+async def _spool_pdf(part, upload_dir):
+    """Stream one multipart file to disk (named by its hash, so the same report is only stored once)."""
+    tmp_path = os.path.join(upload_dir, f".upload-{uuid.uuid4().hex}")
+    h = hashlib.sha256()
+    size = 0
+    with open(tmp_path, "wb") as f:
+        while True:
+            block = await part.read_chunk(UPLOAD_CHUNK_BYTES)
+            if not block:
+                break
+            h.update(block)
+            size += len(block)
+            f.write(block)
+    pdf_path = os.path.join(upload_dir, f"{h.hexdigest()}.pdf")
+    os.replace(tmp_path, pdf_path)
+    return pdf_path, size
+
+
+async def submit_job(request):
+    queue = request.app["queue"]
+    upload_dir = request.app["upload_dir"]
+    if not request.content_type.startswith("multipart/"):
+        raise web.HTTPBadRequest(text="Upload the PDFs as multipart/form-data")
+
+    files, total_bytes = [], 0
+    reader = await request.multipart()
+    async for part in reader:
+        if not part.filename:
+            continue
+        if not part.filename.lower().endswith(".pdf"):
+            raise web.HTTPBadRequest(text=f"Not a PDF: {part.filename}")
+        pdf_path, size = await _spool_pdf(part, upload_dir)
+        total_bytes += size
+        if total_bytes > MAX_UPLOAD_BYTES:
+            raise web.HTTPRequestEntityTooLarge(max_size=MAX_UPLOAD_BYTES, actual_size=total_bytes)
+        files.append((os.path.basename(part.filename), os.path.abspath(pdf_path)))
+
+    if not files:
+        raise web.HTTPBadRequest(text="Please upload at least one PDF.")
+
+    job_id = queue.create_job(files)
+    return web.json_response({"job_id": job_id, "files": len(files)}, status=202)
+
+
+async def get_job(request):
+    status = request.app["queue"].job_status(request.match_info["job_id"])
+    if status is None:
+        raise web.HTTPNotFound(text="Unknown job")
+    return web.json_response(status)
+
+
+async def get_results(request):
+    queue = request.app["queue"]
+    job_id = request.match_info["job_id"]
+    if queue.job_status(job_id) is None:
+        raise web.HTTPNotFound(text="Unknown job")
+    if request.query.get("format") == "parquet":
+        # Written by the workers, so only contains what they have flushed so far
+        return _parquet_response(load_run(job_id, request.app["results_dir"], "results"), f"gpfg_results_{job_id}.parquet")
+
+    results = queue.job_results(job_id)
+    if request.query.get("format") == "csv":
+        buf = io.StringIO()
+        pd.DataFrame([csv_row(r) for r in results]).to_csv(buf, index=False)
+        return web.Response(
+            text=buf.getvalue(), content_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="gpfg_results_{job_id}.csv"'}
+        )
+    return web.json_response({"job_id": job_id, "results": results})
+
+
+async def get_signals(request):
+    job_id = request.match_info["job_id"]
+    if request.app["queue"].job_status(job_id) is None:
+        raise web.HTTPNotFound(text="Unknown job")
+    return _parquet_response(load_run(job_id, request.app["results_dir"], "signals"), f"gpfg_signals_{job_id}.parquet")
+
+
+def _parquet_response(table, filename):
+    return web.Response(
+        body=parquet_bytes(table), content_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+def make_app(db_path=DEFAULT_DB_PATH, upload_dir=DEFAULT_UPLOAD_DIR, results_dir=DEFAULT_RESULTS_DIR):
+    os.makedirs(upload_dir, exist_ok=True)
+    app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+    app["queue"] = JobQueue(db_path)
+    app["upload_dir"] = upload_dir
+    app["results_dir"] = results_dir
+    app.router.add_post("/jobs", submit_job)
+    app.router.add_get("/jobs/{job_id}", get_job)
+    app.router.add_get("/jobs/{job_id}/results", get_results)
+    app.router.add_get("/jobs/{job_id}/signals", get_signals)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ESG classification job service")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite queue file (shared with the workers)")
+    parser.add_argument("--uploads", default=DEFAULT_UPLOAD_DIR, help="Folder for uploaded PDFs (shared with the workers)")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_DIR, help="Parquet result store written by the workers")
+    args = parser.parse_args()
+    web.run_app(make_app(args.db, args.uploads, args.results), host=args.host, port=args.port)
@@ -0,0 +1,184 @@
+"""
+Parameter sweep: runs the pipeline over a fixed set of PDFs for a grid of settings (chunk size, chunk overlap,
+dedup strategy, concurrency, streaming) and compares the outcome with the labelled results workbook.
+
+The LLM calls go to the replay server (replay_server.py), so the runs are deterministic and offline once the
+responses are recorded: run the grid once with --mode record (uses the real API for requests it hasn't seen yet),
+then as often as you like with --mode replay. Every chunk size sends different chunks, so each grid point needs
+its own recording.
+
+Per grid point the table has agreement with NBIM's classification, agreement with the previous LLM run in the
+workbook, calls, tokens, wall clock and time to the first signal. "pareto" marks the settings no other setting beats on agreement, tokens
+and wall clock at the same time.
+
+Run: python3 sweep.py --pdfs reports/ --mode replay --chunk-tokens 3000 5000 8000 --overlap 0 300 --concurrency 5 10
+"""
+
+import os
+import re
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+import pandas as pd
+
+import pipeline
+from pipeline import API_KEY, API_URL, MODEL_NAME, is_error_result, process_all_files_async
+from replay_server import DEFAULT_CASSETTE_DIR, make_app, start_server
+
+DEFAULT_LABELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LLM_ESG_results.xlsx")
+
+# NBIM's decision -> the pipeline's classification it should agree with
+NBIM_TO_CLASSIFICATION = {"Exclusion": "Excluded", "Investment": "Approved", "Observation": "Flagged"}
+
+
+def load_labels(path=DEFAULT_LABELS_PATH):
+    """Workbook rows with the columns the sweep needs (ticker, company, NBIM label, previous LLM classification)."""
+    df = pd.read_excel(path)
+    return pd.DataFrame({
+        "ticker": df["Ticker"].astype(str).str.strip().str.upper(),
+        "company_key": df["Company"].astype(str).map(_name_key),
+        "expected": df["NBIM Classification"].map(NBIM_TO_CLASSIFICATION),
+        "baseline": df["LLM Classification"],
+    })
+
+
+def _name_key(name):
+    name = re.sub(r"\b(inc|corp|corporation|co|ltd|plc|asa|ab|sa|nv|ag|the)\b", " ", str(name).lower())
+    return re.sub(r"[^a-z0-9]", "", name)
+
+
+def match_label(file_name, labels):
+    """Label row for a PDF, by ticker (first word of the file name) or by company name. None if not found."""
+    stem = os.path.splitext(file_name)[0]
+    first_word = re.split(r"[\s_\-]+", stem.upper())[0]
+    hit = labels.index[labels["ticker"] == first_word]
+    if len(hit):
+        return labels.loc[hit[0]]
+    key = _name_key(stem)
+    hit = labels.index[labels["company_key"].map(lambda k: bool(k) and (k in key or key in k))] if key else []
+    return labels.loc[hit[0]] if len(hit) else None
+
+
+def combined_classification(row):
+    """Flagged cases counted on the side they lean to (the workbook's Combined_Classification)."""
+    if row.get("classification") == "Flagged" and row.get("flagged_lean") in ("Approved", "Excluded"):
+        return row["flagged_lean"]
+    return row.get("classification")
+
+
+def score(rows, labels):
+    """Agreement of one run's rows with the workbook."""
+    agree, exclusions_found, exclusions, baseline_agree, matched = 0, 0, 0, 0, 0
+    for row in rows:
+        label = match_label(row["file"], labels)
+        if label is None:
+            continue
+        matched += 1
+        # Observation is only matched by an explicit Flagged, the other labels by the combined classification
+        predicted = row.get("classification") if label["expected"] == "Flagged" else combined_classification(row)
+        agree += predicted == label["expected"]
+        if label["expected"] == "Excluded":
+            exclusions += 1
+            exclusions_found += predicted == "Excluded"
+        baseline_agree += row.get("classification") == label["baseline"]
+    return {
+        "labelled_files": matched,
+        "agree_nbim": round(agree / matched, 3) if matched else None,
+        "exclusion_recall": round(exclusions_found / exclusions, 3) if exclusions else None,
+        "agree_previous_run": round(baseline_agree / matched, 3) if matched else None,
+    }
+
+
+def pareto_front(df, maximise=("agree_nbim",), minimise=("total_tokens", "wall_clock_sec")):
+    """True for the rows no other row is at least as good as on every objective and better on one."""
+    values = df[list(maximise) + list(minimise)].fillna(0).to_numpy(dtype=float)
+    values[:, len(maximise):] *= -1  # Everything "higher is better"
+    front = []
+    for v in values:
+        dominated = ((values >= v).all(axis=1) & (values > v).any(axis=1)).any()
+        front.append(not dominated)
+    return pd.Series(front, index=df.index)
+
+
+async def run_point(file_list, url, model, settings, stats):
+    """One pipeline run with the given settings. Returns (rows, measurements)."""
+    pipeline.CHUNK_TARGET_TOKENS = settings["chunk_tokens"]
+    pipeline.CHUNK_OVERLAP_TOKENS = settings["overlap"]
+    pipeline.DEDUP_STRATEGY = settings["dedup"]
+    pipeline.STREAM_RESPONSES = settings.get("stream", False)
+
+    before_calls = pipeline.CALL_STATS.snapshot()
+    before_misses = stats["misses"]
+    started = time.monotonic()
+    rows = await process_all_files_async(file_list, API_KEY, model, url, settings["concurrency"])
+    wall_clock = time.monotonic() - started
+
+    calls = prompt_tokens = completion_tokens = 0
+    for m, s in pipeline.CALL_STATS.snapshot().items():
+        b = before_calls.get(m, {})
+        calls += s["calls"] - b.get("calls", 0)
+        prompt_tokens += s["prompt_tokens"] - b.get("prompt_tokens", 0)
+        completion_tokens += s["completion_tokens"] - b.get("completion_tokens", 0)
+    return rows, {
+        "calls": calls,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "wall_clock_sec": round(wall_clock, 2),
+        "first_signal_sec": round(pd.Series([r.get("first_signal_sec") for r in rows], dtype=float).mean(), 2),
+        "replay_misses": stats["misses"] - before_misses,
+        "errors": sum(is_error_result(r) for r in rows),
+    }
+
+
+async def sweep(file_list, labels, grid, model=MODEL_NAME, mode="replay", cassette_dir=DEFAULT_CASSETTE_DIR,
+                latency_scale=1.0):
+    """Run every combination of the grid (a dict of setting -> list of values). Returns the sweep table."""
+    app = make_app(cassette_dir, mode, API_URL, API_KEY, latency_scale)
+    runner, url = await start_server(app)
+    names = list(grid)
+    points = []
+    try:
+        for values in itertools.product(*(grid[n] for n in names)):
+            settings = dict(zip(names, values))
+            if settings["overlap"] >= settings["chunk_tokens"]:
+                logging.warning(f"Skipped {settings}: the overlap must be smaller than the chunk size")
+                continue
+            logging.info(f"Sweep point {len(points) + 1}: {settings}")
+            rows, measured = await run_point(file_list, url, model, settings, app["stats"])
+            points.append({**settings, **score(rows, labels), **measured})
+    finally:
+        await runner.cleanup()
+
+    table = pd.DataFrame(points)
+    table["pareto"] = pareto_front(table)
+    return table.sort_values(["pareto", "agree_nbim", "total_tokens"], ascending=[False, False, True])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy vs throughput sweep over pipeline settings")
+    parser.add_argument("--pdfs", required=True, help="Folder with the PDFs to run (file names start with the ticker)")
+    parser.add_argument("--labels", default=DEFAULT_LABELS_PATH, help="Labelled results workbook")
+    parser.add_argument("--mode", choices=("record", "replay"), default="replay")
+    parser.add_argument("--cassettes", default=DEFAULT_CASSETTE_DIR, help="Folder with the recorded responses")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplier on the recorded latency (0 = none)")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--chunk-tokens", type=int, nargs="+", default=[pipeline.CHUNK_TARGET_TOKENS])
+    parser.add_argument("--overlap", type=int, nargs="+", default=[pipeline.CHUNK_OVERLAP_TOKENS])
+    parser.add_argument("--dedup", nargs="+", choices=("prefix", "exact", "criterion"), default=[pipeline.DEDUP_STRATEGY])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[pipeline.MAX_CONCURRENT_REQUESTS])
+    parser.add_argument("--stream", nargs="+", choices=("off", "on"), default=["on" if pipeline.STREAM_RESPONSES else "off"])
+    parser.add_argument("--out", default="sweep_results.csv")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    pdfs = sorted(f for f in os.listdir(args.pdfs) if f.lower().endswith(".pdf"))
+    file_list = [(f, os.path.join(args.pdfs, f)) for f in pdfs]
+    grid = {"chunk_tokens": args.chunk_tokens, "overlap": args.overlap, "dedup": args.dedup,
+            "concurrency": args.concurrency, "stream": [v == "on" for v in args.stream]}
+    table = asyncio.run(sweep(file_list, load_labels(args.labels), grid, args.model, args.mode, args.cassettes,
+                              args.latency_scale))
+    table.to_csv(args.out, index=False)
+    print(table.to_string(index=False))
@@ -0,0 +1,107 @@
+"""Tests for the regex coal figures (run: python3 -m pytest test_coal_metrics.py)."""
+
+import pytest
+
+from coal_metrics import coal_signals, coal_table_mask, extract_coal_metrics
+
+
+def _values(text, metric):
+    metrics = extract_coal_metrics([text])
+    return sorted(metrics.loc[metrics["metric"] == metric, "value"].round(3))
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("We produced 45 million tonnes of thermal coal in 2023.", [45.0]),
+    ("Coal production was 52.3 Mt in 2023 and 48.1 Mt in 2022.", [48.1, 52.3]),
+    ("Coal production was 52.3 Mt, up from 48.1 Mt in 2022.", [52.3]),  # Only the figure in the same clause
+    ("A total of 1,200 thousand tonnes of coal were mined at the Kestrel site.", [1.2]),
+    ("Our mines extracted 2.1 billion tonnes of coal over their lifetime.", [2100.0]),
+    ("Thermal coal output reached 31 mtpa.", [31.0]),
+    # Reserves, resources and emissions are in tonnes too, but are not production
+    ("Our coal reserves amount to 2.1 billion tonnes.", []),
+    ("Coal resources at the mine are estimated at 800 million tonnes, with 45 Mt produced to date.", []),
+    ("We cut CO2 emissions by 35 million tonnes by closing coal plants.", []),
+    ("Coal-fired plants emitted 12 million tonnes of greenhouse gases.", []),
+    # Tonnes without a production word nearby
+    ("The port handled 60 million tonnes of cargo, including coal.", []),
+    ("We shipped 30 Mt of coal to customers in India.", []),
+])
+def test_coal_tonnes(text, expected):
+    assert _values(text, "coal_mt") == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Thermal coal accounted for 45% of our revenue in 2023.", [45.0]),
+    ("45 percent of group revenue came from thermal coal sales.", [45.0]),
+    ("Coal made up 62.5% of electricity generation.", [62.5]),
+    # The percentage is not about coal
+    ("Revenue increased 45% year on year, while coal sales declined.", []),
+    ("Revenue increased 45% while coal sales declined.", []),
+    ("Renewables were 70% of generation; coal was phased out in 2020.", []),
+    ("Coal sales fell, but total revenue grew 12%.", []),
+    # Coal percentages without a revenue/operations context
+    ("We aim to cut coal use by 50% by 2030.", []),
+])
+def test_coal_share(text, expected):
+    assert _values(text, "coal_share_pct") == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Our coal-fired capacity is 12,500 MW across six plants.", [12500.0]),
+    ("The coal plant fleet has 4.2 GW of generation capacity.", [4200.0]),
+    ("The wind farm adds 300 MW.", []),
+    # Capacity that is not coal-fired
+    ("We added 12,000 MW of solar and wind capacity in 2023 and closed our last coal plant.", []),
+    ("Total generation capacity is 25,000 MW, of which coal accounts for 2,000 MW.", [2000.0]),
+])
+def test_coal_capacity(text, expected):
+    assert _values(text, "coal_mw") == expected
+
+
+@pytest.mark.parametrize("text, coal, total", [
+    ("Coal revenue was USD 500 million while total revenue was USD 1,000 million.", [500.0], [1000.0]),
+    ("Thermal coal sales brought in $2.5 billion.", [2500.0], []),
+    ("Total revenue was USD 5,400 million, most of it from coal.", [], [5400.0]),
+    # Coal and revenue in the sentence, but the amount is about something else
+    ("Coal capex was USD 200 million, while revenue rose.", [], []),
+])
+def test_coal_revenue(text, coal, total):
+    assert _values(text, "coal_revenue_m") == coal
+    assert _values(text, "total_revenue_m") == total
+
+
+def test_signals_are_low_confidence_leads():
+    metrics = extract_coal_metrics([
+        "We produced 45 million tonnes of thermal coal in 2023.",
+        "Coal production was 12 million tonnes at the smaller mine.",
+    ])
+    [signal] = coal_signals(metrics)
+    assert signal["confidence"] == "low"
+    assert signal["severity"] != "serious"
+    assert "THRESHOLD MET" not in signal["quantitative_data"]
+    assert "45.0 million tonnes" in signal["quantitative_data"]
+    assert "largest of 2 figures" in signal["quantitative_data"]
+    assert signal["chunk"] == 1
+
+
+def test_no_signals_without_figures():
+    assert coal_signals(extract_coal_metrics(["Our coal reserves amount to 2.1 billion tonnes."])) == []
+
+
+_TABLE = "Coal production (Mt)\n2023 2022 2021\n" + "\n".join(f"Mine {i} {45.2 - i:.1f} {44.1 - i:.1f} {40.3 - i:.1f}" for i in range(12))
+_PROSE = ("The board reviewed the strategy for the coming years and discussed the outlook for the markets "
+          "we operate in, the safety performance of our sites and our approach to community engagement. ") * 5
+
+
+@pytest.mark.parametrize("text, skipped", [
+    (_TABLE + "\n\nWe produced 45.2 million tonnes of coal in 2023.", True),
+    # Same table with a page of prose next to it: the chunk as a whole is not a table
+    (_TABLE + "\n\nWe produced 45.2 million tonnes of coal in 2023.\n\n" + _PROSE, False),
+    # Table with a conduct keyword
+    (_TABLE + "\n\nWe produced 45.2 million tonnes of coal in 2023.\n\nFatalities 2 1 0", False),
+    # Table without a coal figure
+    (_TABLE, False),
+])
+def test_coal_table_mask(text, skipped):
+    metrics = extract_coal_metrics([text])
+    assert coal_table_mask([text], metrics).tolist() == [skipped]
@@ -0,0 +1,61 @@
+"""Tests for the evidence check of MAP quotes (run: python3 -m pytest test_evidence_index.py)."""
+
+import pytest
+
+from evidence_index import EvidenceIndex, verify_signals
+
+PAGES = [
+    "Annual report 2023\n\nOur strategy is to grow the renewable business across all markets.",
+    "Risk factors\n\nIn 2023 the group produced 45 million tonnes of thermal coal at its four mines in Queens-\nland, "
+    "and a fatal accident occurred at the Kestrel mine in March.",
+    "Outlook\n\nWe plan to reduce coal production below 30% of revenue by 2030, subject to market conditions.",
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return EvidenceIndex(PAGES)
+
+
+@pytest.mark.parametrize("quote, page, min_coverage", [
+    # Exact quote, and the same quote with different case, punctuation and line breaks
+    ("the group produced 45 million tonnes of thermal coal", 2, 1.0),
+    ("The Group produced 45 million tonnes of thermal coal!", 2, 1.0),
+    # Hyphenated across a line break in the report
+    ("four mines in Queensland, and a fatal accident occurred", 2, 1.0),
+    # "..." cut in the middle of the quote
+    ("In 2023 the group produced 45 million tonnes ... a fatal accident occurred at the Kestrel mine", 2, 0.6),
+    # Quote running over a page break is attributed to the page most of it is on
+    ("at the Kestrel mine in March. Outlook We plan to reduce coal production below 30% of revenue", 3, 0.9),
+    # Short quotes (fewer than 5 words) must match as a whole
+    ("Kestrel mine", 2, 1.0),
+    ("reduce coal production", 3, 1.0),
+])
+def test_locate_found(index, quote, page, min_coverage):
+    found_page, coverage = index.locate(quote)
+    assert found_page == page
+    assert coverage >= min_coverage
+
+
+@pytest.mark.parametrize("quote", [
+    "The company is a leading producer of cluster munitions in Europe",  # Not in the report
+    "Kestrel coal",  # Short, words present but not together
+    "",
+])
+def test_locate_not_found(index, quote):
+    assert index.locate(quote) == (None, 0.0)
+
+
+def test_paraphrase_is_not_verified(index):
+    _, coverage = index.locate("The group mined about 45 Mt of coal for power stations in Queensland last year")
+    assert coverage < 0.6
+
+
+def test_verify_signals(index):
+    signals = [
+        {"evidence": "a fatal accident occurred at the Kestrel mine in March"},
+        {"evidence": "The company sells tobacco products in forty countries worldwide"},
+        {"criterion": "no evidence"},
+    ]
+    assert verify_signals(signals, index) == 2
+    assert [(s["page"], s["verified"]) for s in signals] == [(2, True), (None, False), (None, False)]
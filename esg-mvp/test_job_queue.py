@@ -0,0 +1,64 @@
+"""Tests for the SQLite job queue: leases, attempt limits, lease holders (run: python3 -m pytest test_job_queue.py)."""
+
+import pytest
+
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "queue.db"))
+
+
+def _crash(queue, worker_id):
+    """Claim the next task with a lease that has already run out, as if the worker died right away."""
+    return queue.claim_task(worker_id, lease_sec=-1)
+
+
+def test_expired_lease_is_handed_out_again(queue):
+    job_id = queue.create_job([("a.pdf", "/x/a.pdf")])
+    first = _crash(queue, "w1")
+    second = queue.claim_task("w2")
+    assert second["task_id"] == first["task_id"]
+    assert second["attempts"] == 2
+    assert queue.job_status(job_id)["tasks"]["running"] == 1
+
+
+def test_task_that_kills_every_worker_is_failed_after_max_attempts(queue):
+    job_id = queue.create_job([("crash.pdf", "/x/crash.pdf"), ("ok.pdf", "/x/ok.pdf")])
+    given_up = []
+    for i in range(3):
+        task = _crash(queue, f"w{i}")
+        assert task["file_name"] == "crash.pdf" and task["attempts"] == i + 1
+
+    # The fourth claim gives up on crash.pdf and hands out the next task instead
+    task = queue.claim_task("w3", on_give_up=lambda job, row: given_up.append((job, row)))
+    assert task["file_name"] == "ok.pdf"
+    assert [(job, row["file"]) for job, row in given_up] == [(job_id, "crash.pdf")]
+    assert given_up[0][1]["criteria_triggered"] == ["Processing_Error"]
+
+    assert queue.complete_task(task["task_id"], "w3", {"file": "ok.pdf"})
+    status = queue.job_status(job_id)
+    assert status["status"] == "done"
+    assert status["tasks"]["failed"] == 1 and status["tasks"]["done"] == 1
+    assert [r["file"] for r in queue.job_results(job_id)] == ["crash.pdf", "ok.pdf"]
+    assert queue.claim_task("w4") is None
+
+
+def test_fail_task_requeues_until_attempts_run_out(queue):
+    job_id = queue.create_job([("a.pdf", "/x/a.pdf")])
+    for attempt in range(1, 4):
+        task = queue.claim_task("w1")
+        expected = "queued" if attempt < 3 else "failed"
+        assert queue.fail_task(task["task_id"], "w1", "boom", {"file": "a.pdf"}) == expected
+    assert queue.claim_task("w1") is None
+    assert queue.job_results(job_id) == [{"file": "a.pdf"}]
+
+
+def test_only_the_lease_holder_can_finish_a_task(queue):
+    queue.create_job([("a.pdf", "/x/a.pdf")])
+    stale = _crash(queue, "w1")
+    current = queue.claim_task("w2")
+    assert not queue.complete_task(stale["task_id"], "w1", {"file": "stale"})
+    assert queue.fail_task(stale["task_id"], "w1", "late error") is None
+    assert queue.complete_task(current["task_id"], "w2", {"file": "a.pdf"})
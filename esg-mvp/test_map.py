@@ -0,0 +1,109 @@
+"""
+Tests for the MAP calls against the replay server (run: python3 -m pytest test_map.py).
+Every answer is a recorded cassette in a temporary folder, so nothing leaves the machine.
+"""
+
+import json
+import asyncio
+
+import aiohttp
+import pytest
+
+import pipeline
+from replay_server import CassetteStore, make_app, request_key, start_server
+
+CHUNK = "We produced 45 million tonnes of thermal coal in 2023."
+
+
+def _record(cassettes, model, content, chunk=CHUNK):
+    msgs = [{"role": "system", "content": pipeline.MAP_SYSTEM},
+            {"role": "user", "content": pipeline.MAP_USER_PREFIX + chunk}]
+    CassetteStore(str(cassettes)).put(request_key({"model": model, "messages": msgs}),
+                                      {"latency_sec": 0.0, "response": {"choices": [{"message": {"content": content}}]}})
+
+
+def _run(cassettes, call, cut_streams_at=None, stats=None):
+    """Start the replay server, run call(url, session) against it and return its result (stats gets the server's)."""
+    async def main():
+        app = make_app(str(cassettes), "replay", cut_streams_at=cut_streams_at)
+        runner, url = await start_server(app)
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await call(url, session)
+        finally:
+            if stats is not None:
+                stats.update(app["stats"])
+            await runner.cleanup()
+    return asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    async def no_sleep(_):
+        return None
+    monkeypatch.setattr(pipeline.asyncio, "sleep", no_sleep)
+
+
+def test_failed_triage_call_goes_to_the_main_model(tmp_path, monkeypatch):
+    # No cassette for the triage model, so its calls fail (HTTP 404), as with a wrong model name
+    monkeypatch.setattr(pipeline, "MAP_TRIAGE_MODEL", "broken-triage")
+    _record(tmp_path, "main", json.dumps({"signals": [{"criterion": "§3(2)-coal", "evidence": CHUNK}]}))
+    out = _run(tmp_path, lambda url, session: pipeline.map_cascade_async(CHUNK, "k", "main", url, session))
+    assert [(s["criterion"], s["model"]) for s in out["signals"]] == [("§3(2)-coal", "main")]
+
+
+def test_empty_triage_answer_is_not_escalated(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "MAP_TRIAGE_MODEL", "triage")
+    _record(tmp_path, "triage", json.dumps({"signals": []}))
+    out = _run(tmp_path, lambda url, session: pipeline.map_cascade_async(CHUNK, "k", "main", url, session))
+    assert out["signals"] == [] and not out.get("failed")
+
+
+# Two signals; the second is long, so 70% of the answer ends after the first one and inside the second
+TWO_SIGNALS = json.dumps({"signals": [
+    {"criterion": "§3(2)-coal", "evidence": 'He said "we are done}" and {left} the mine', "severity": "serious"},
+    {"criterion": "§4(d)", "evidence": "Fatal accident at the Kestrel mine. " * 10, "severity": "moderate"},
+]})
+
+
+def _map(url, session, on_signal=None):
+    return pipeline.map_extract_signals_async(CHUNK, "k", "main", url, session, on_signal=on_signal)
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    monkeypatch.setattr(pipeline, "STREAM_RESPONSES", True)
+
+
+def test_stream_parser_handles_braces_and_quotes_in_strings():
+    parser = pipeline.SignalStreamParser()
+    found = []
+    for i in range(0, len(TWO_SIGNALS), 7):
+        found.extend(parser.feed(TWO_SIGNALS[i:i + 7]))
+    assert found == json.loads(TWO_SIGNALS)["signals"]
+
+
+def test_complete_stream(tmp_path, streaming):
+    _record(tmp_path, "main", TWO_SIGNALS)
+    live = []
+    out = _run(tmp_path, lambda url, session: _map(url, session, live.append))
+    assert out["signals"] == json.loads(TWO_SIGNALS)["signals"]
+    assert live == out["signals"]
+
+
+def test_stream_cut_after_first_signal_keeps_it(tmp_path, streaming):
+    _record(tmp_path, "main", TWO_SIGNALS)
+    stats = {}
+    out = _run(tmp_path, _map, cut_streams_at=0.7, stats=stats)
+    assert [s["criterion"] for s in out["signals"]] == ["§3(2)-coal"]
+    assert out["signals"][0]["evidence"] == 'He said "we are done}" and {left} the mine'
+    assert stats["hits"] == 1  # Kept, not retried
+
+
+def test_stream_cut_before_first_signal_is_retried(tmp_path, streaming):
+    _record(tmp_path, "main", TWO_SIGNALS)
+    stats = {}
+    out = _run(tmp_path, _map, cut_streams_at=0.2, stats=stats)
+    # Every replayed stream is cut, so all attempts fail and the chunk is reported as failed, not as empty
+    assert stats["hits"] == 5
+    assert out == {"signals": [], "failed": True}
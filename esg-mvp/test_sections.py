@@ -0,0 +1,38 @@
+"""Tests for section tagging and section-aware chunking (run: python3 -m pytest test_sections.py)."""
+
+import pytest
+
+import pipeline
+from sections import page_sections, split_sections
+
+PAGES = ["Our business and strategy. " * 20, "We audited the financial statements. " * 20, "Climate risk. " * 20]
+TOC = [[1, "Strategy", 1], [1, "Independent auditor's report", 2], [1, "Risk factors", 3]]
+
+
+@pytest.mark.parametrize("toc, expected", [
+    # A skipped section and a kept one start on page 2: the page is kept
+    ([[1, "Report", 1], [2, "Auditor's report", 2], [2, "Risk", 2]],
+     [["Report"], ["Report", "Risk"], ["Report", "Risk"]]),
+    ([[1, "Report", 1], [2, "Risk", 2], [2, "Auditor's report", 2]],
+     [["Report"], ["Report", "Risk"], ["Report", "Auditor's report"]]),
+    # A parent and its child starting on the same page are one heading
+    ([[1, "Report", 1], [1, "Notes", 2], [2, "Segments", 2]],
+     [["Report"], ["Notes", "Segments"], ["Notes", "Segments"]]),
+    # Only skipped sections start on the page: it is skipped
+    ([[1, "Report", 1], [1, "Auditor's report", 2], [1, "Basis of preparation", 2]],
+     [["Report"], ["Auditor's report"], ["Basis of preparation"]]),
+])
+def test_page_sections(toc, expected):
+    assert page_sections(toc, ["text"] * 3) == expected
+
+
+def _chunk_titles(**kwargs):
+    chunks = pipeline.chunk_sections(split_sections(PAGES, TOC), 5000, 300, **kwargs)
+    return [c["section"] for c in chunks]
+
+
+def test_skip_setting_is_read_when_called(monkeypatch):
+    assert _chunk_titles() == ["Risk factors", "Strategy"]
+    monkeypatch.setattr(pipeline, "SKIP_LOW_YIELD_SECTIONS", False)
+    assert _chunk_titles() == ["Risk factors", "Strategy | Independent auditor's report"]
+    assert _chunk_titles(skip_low_yield=True) == ["Risk factors", "Strategy"]
@@ -0,0 +1,133 @@
+"""
+Queue worker: pulls one PDF at a time from the SQLite job queue and runs the MAP-REDUCE pipeline on it.
+Start as many processes as the API quota allows, on the host that has the queue file and upload folder.
+
+Results and MAP signals are also appended to the Parquet result store, partitioned by job.
+
+Run: python3 worker.py --db esg_queue.db
+     python3 worker.py --db esg_queue.db --exit-when-idle   (for scheduled screening runs)
+"""
+
+import os
+import socket
+import asyncio
+import logging
+import argparse
+
+from job_queue import JobQueue, DEFAULT_DB_PATH, TASK_LEASE_SEC
+from pipeline import (
+    API_KEY,
+    CALL_STATS,
+    API_URL,
+    MODEL_NAME,
+    MAX_CONCURRENT_REQUESTS,
+    error_result,
+    is_error_result,
+    make_session,
+    process_single_file_async
+)
+from result_store import ResultStore, DEFAULT_RESULTS_DIR
+
+POLL_INTERVAL_SEC = 2.0  # Wait between queue checks when there is nothing to do
+
+log = logging.getLogger("esg.worker")
+
+
+async def _keep_lease(queue, task_id, worker_id):
+    """Renew the lease while the task is being processed, so slow reports are not handed out twice."""
+    while True:
+        await asyncio.sleep(TASK_LEASE_SEC / 3)
+        await asyncio.to_thread(queue.renew_lease, task_id, worker_id)
+
+
+async def process_task(queue, task, worker_id, key, model, url, max_concurrent, session, store):
+    file_name = task["file_name"]
+    signals = []
+    lease = asyncio.create_task(_keep_lease(queue, task["task_id"], worker_id))
+    try:
+        row = await process_single_file_async(
+            file_name, task["pdf_path"], key, model, url, max_concurrent, session,
+            lambda msg: log.info(msg), None,
+            lambda name, s: signals.extend(s)
+        )
+    except Exception as e:
+        row = error_result(file_name, f"Unexpected error: {str(e)[:200]}")
+    finally:
+        lease.cancel()
+
+    # The pipeline turns errors into a Processing_Error row; retry those a few times before keeping the row
+    if is_error_result(row):
+        status = await asyncio.to_thread(queue.fail_task, task["task_id"], worker_id, row.get("reasoning", ""), row)
+        if status is None:
+            log.warning(f"{file_name}: lease lost to another worker, attempt {task['attempts']} discarded")
+            return
+        log.warning(f"{file_name}: attempt {task['attempts']} failed: {row.get('reasoning', '')[:200]}")
+        if status == "failed":
+            # Out of attempts: the error row is the file's result, in the store as well as in the queue
+            await asyncio.to_thread(store.add_result, row)
+    else:
+        if not await asyncio.to_thread(queue.complete_task, task["task_id"], worker_id, row):
+            log.warning(f"{file_name}: lease lost to another worker, result discarded")
+            return
+        store.add_signals(file_name, signals)
+        await asyncio.to_thread(store.add_result, row)
+        log.info(f"{file_name}: {row.get('classification')}")
+
+
+def _flush_stores(stores):
+    for store in stores.values():
+        store.flush()
+    stores.clear()
+
+
+async def run_worker(queue, worker_id, key, model, url, max_concurrent, exit_when_idle=False,
+                     results_dir=DEFAULT_RESULTS_DIR):
+    """Claim and process tasks until stopped (or until the queue is empty, with exit_when_idle)."""
+    stores = {}  # job_id -> ResultStore
+
+    def store_for(job_id):
+        # Every file's row (and its signals) is written as soon as it is final: a file takes minutes, so the
+        # extra part files cost little, and a finished job's results never wait for the queue to run dry
+        # (or get lost if the worker is killed)
+        if job_id not in stores:
+            stores[job_id] = ResultStore(results_dir, job_id, flush_every=1)
+        return stores[job_id]
+
+    def give_up(job_id, row):
+        # A task whose workers all died: its error row goes to the store like any other final failure
+        log.warning(f"{row['file']}: {row['reasoning']}")
+        store_for(job_id).add_result(row)
+
+    try:
+        async with make_session(max_concurrent) as session:
+            while True:
+                task = await asyncio.to_thread(queue.claim_task, worker_id, on_give_up=give_up)
+                if task is None:
+                    if stores:
+                        log.info(f"LLM calls per tier so far: {CALL_STATS.summary()}")
+                    await asyncio.to_thread(_flush_stores, stores)
+                    if exit_when_idle:
+                        return
+                    await asyncio.sleep(POLL_INTERVAL_SEC)
+                    continue
+                await process_task(queue, task, worker_id, key, model, url, max_concurrent, session,
+                                   store_for(task["job_id"]))
+    finally:
+        _flush_stores(stores)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ESG classification queue worker")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite queue file (shared with the service)")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS,
+                        help="Parallel MAP requests for this worker")
+    parser.add_argument("--exit-when-idle", action="store_true", help="Stop when there are no queued tasks left")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_DIR, help="Parquet result store (shared with the service)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    asyncio.run(run_worker(
+        JobQueue(args.db), worker_id, API_KEY, MODEL_NAME, API_URL, args.concurrency, args.exit_when_idle,
+        args.results
+    ))